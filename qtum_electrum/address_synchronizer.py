@@ -20,11 +20,12 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import heapq
+import sys
 import time
 import threading
+import weakref
 from collections import defaultdict
-from functools import reduce
-import itertools
 from operator import itemgetter
 
 from . import qtum
@@ -41,6 +42,8 @@ TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
 
+_MISSING = object()  # cache lookup sentinel
+
 
 class AddTransactionException(Exception):
     pass
@@ -83,11 +86,24 @@ class AddressSynchronizer(PrintError):
             self.verified_tx[txid] = VerifiedTxInfo(height, timestamp, txpos, header_hash)
         # Transactions pending verification.  txid -> tx_height. Access with self.lock.
         self.unverified_tx = defaultdict(int)
+        # txids verified since the last 'verified' notification. Access with self.lock.
+        self._pending_verified_notif = []
         # true when synchronized
         self.up_to_date = False
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
         self._get_addr_balance_cache = {}
+        # heap of (height, address): the cached balance of address has
+        # coinbase outputs maturing at height. Access with self.lock.
+        self._balance_maturity_heap = []
+        # address -> lowest height it is scheduled for in the heap
+        self._balance_maturity = {}
+        # the local height the cached balances were computed against
+        self._balance_cache_height = 0
+        # tx -> (epoch, result) of get_wallet_delta. The epoch is bumped
+        # whenever txo or the set of our addresses changes.
+        self._wallet_delta_cache = weakref.WeakKeyDictionary()
+        self._mine_epoch = 0
         self.load_and_cleanup()
 
     def with_transaction_lock(func):
@@ -131,11 +147,9 @@ class AddressSynchronizer(PrintError):
             return addr
         prevout_hash = txi.get('prevout_hash')
         prevout_n = txi.get('prevout_n')
-        dd = self.txo.get(prevout_hash, {})
-        for addr, l in dd.items():
-            for n, v, is_cb in l:
-                if n == prevout_n:
-                    return addr
+        prevout = self._txo_by_n.get(prevout_hash, {}).get(prevout_n)
+        if prevout:
+            return prevout[0]
         return None
 
     def get_txout_address(self, txo: TxOutput):
@@ -172,7 +186,23 @@ class AddressSynchronizer(PrintError):
             self.synchronizer = None
 
     def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
+        # Only the unmatured part of a balance depends on the chain tip, so
+        # re-bucket just the addresses with coinbase outputs maturing now.
+        # If the tip moved backwards, coinbases might become unmatured again.
+        local_height = self.get_local_height()
+        with self.lock:
+            if local_height < self._balance_cache_height:
+                self._get_addr_balance_cache = {}  # invalidate cache
+                self._balance_maturity_heap = []
+                self._balance_maturity = {}
+            else:
+                heap = self._balance_maturity_heap
+                while heap and heap[0][0] <= local_height:
+                    height, addr = heapq.heappop(heap)
+                    if self._balance_maturity.get(addr) == height:
+                        del self._balance_maturity[addr]
+                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+            self._balance_cache_height = local_height
 
     def stop_threads(self):
         if self.network:
@@ -191,6 +221,7 @@ class AddressSynchronizer(PrintError):
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
+            self._mine_epoch += 1
             self.set_up_to_date(False)
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -241,9 +272,9 @@ class AddressSynchronizer(PrintError):
                 # note that during sync, if the transactions are not properly sorted,
                 # it could happen that we think tx is unrelated but actually one of the inputs is is_mine.
                 # this is the main motivation for allow_unrelated
-                is_mine = any([self.is_mine(self.get_txin_address(txin)) for txin in tx.inputs()])
-                is_for_me = any([self.is_mine(self.get_txout_address(txo)) for txo in tx.outputs()])
-                if not is_mine and not is_for_me:
+                is_mine = any(self.is_mine(self.get_txin_address(txin)) for txin in tx.inputs())
+                is_for_me = is_mine or any(self.is_mine(self.get_txout_address(txo)) for txo in tx.outputs())
+                if not is_for_me:
                     raise UnrelatedTransactionException()
             # Find all conflicting transactions.
             # In case of a conflict,
@@ -273,53 +304,71 @@ class AddressSynchronizer(PrintError):
                     to_remove |= self.get_depending_transactions(conflicting_tx_hash)
                 for tx_hash2 in to_remove:
                     self.remove_transaction(tx_hash2)
-            # add inputs
-            def add_value_from_prev_output():
-                dd = self.txo.get(prevout_hash, {})
-                # note: this nested loop takes linear time in num is_mine outputs of prev_tx
-                for addr, outputs in dd.items():
-                    # note: instead of [(n, v, is_cb), ...]; we could store: {n -> (v, is_cb)}
-                    for n, v, is_cb in outputs:
-                        if n == prevout_n:
-                            if addr and self.is_mine(addr):
-                                if d.get(addr) is None:
-                                    d[addr] = set()
-                                d[addr].add((ser, v))
-                                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
-                            return
-            self.txi[tx_hash] = d = {}
+            balance_cache = self._get_addr_balance_cache
+            spent_outpoints = self.spent_outpoints
+            addr_received = self._addr_received
+            addr_sent = self._addr_sent
+            # we might be re-adding tx_hash; txi/txo are rebuilt from scratch
+            self._remove_tx_from_addr_io(tx_hash)
+            # add inputs. txi and txo entries are published once complete,
+            # for the benefit of lock-free readers (get_tx_delta)
+            d = {}
+            spent = set()
             for txi in tx.inputs():
                 if txi['type'] == 'coinbase':
                     continue
                 prevout_hash = txi['prevout_hash']
                 prevout_n = txi['prevout_n']
-                ser = prevout_hash + ':%d' % prevout_n
-                self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
-                add_value_from_prev_output()
+                ser = (prevout_hash, prevout_n)
+                spent_outpoints[prevout_hash][prevout_n] = tx_hash
+                spent.add(ser)
+                # add value from prev output
+                prevout = self._txo_by_n.get(prevout_hash, {}).get(prevout_n)
+                if prevout is None:
+                    continue
+                addr, v, is_cb = prevout
+                if addr and self.is_mine(addr):
+                    d.setdefault(addr, set()).add((ser, v))
+                    addr_sent.setdefault(addr, {})[ser] = tx_hash
+                    balance_cache.pop(addr, None)  # invalidate cache
+            if spent:
+                self._spent_outpoints_by_txid.setdefault(tx_hash, set()).update(spent)
+            self.txi[tx_hash] = d
+            self._txi_dirty.add(tx_hash)
             # add outputs
-            self.txo[tx_hash] = d = {}
+            d = {}
+            self._txo_by_n[tx_hash] = by_n = {}
+            spenders = spent_outpoints.get(tx_hash, {})
             for n, txo in enumerate(tx.outputs()):
-                v = txo[2]
-                ser = tx_hash + ':%d'%n
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
-                    if d.get(addr) is None:
-                        d[addr] = []
-                    d[addr].append((n, v, is_coinbase))
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                    # the same address string is shared by all entries
+                    addr = sys.intern(addr)
+                    v = txo[2]
+                    ser = (tx_hash, n)
+                    d.setdefault(addr, []).append((n, v, is_coinbase))
+                    by_n[n] = (addr, v, is_coinbase)
+                    addr_received.setdefault(addr, {})[ser] = (v, is_coinbase)
+                    balance_cache.pop(addr, None)  # invalidate cache
                     # give v to txi that spends me
-                    next_tx = self.spent_outpoints[tx_hash].get(n)
+                    next_tx = spenders.get(n)
                     if next_tx is not None:
-                        dd = self.txi.get(next_tx, {})
-                        if dd.get(addr) is None:
-                            dd[addr] = set()
-                        if (ser, v) not in dd[addr]:
-                            dd[addr].add((ser, v))
+                        next_txi = self.txi.get(next_tx)
+                        if next_txi is not None:
+                            dd = next_txi.setdefault(addr, set())
+                            if (ser, v) not in dd:
+                                dd.add((ser, v))
+                                self._txi_dirty.add(next_tx)
+                            addr_sent.setdefault(addr, {})[ser] = next_tx
                         self._add_tx_to_local_history(next_tx)
+            for addr, rows in d.items():
+                d[addr] = tuple(rows)
+            self.txo[tx_hash] = d
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
             self.transactions[tx_hash] = tx
+            self._mine_epoch += 1
             return True
 
     def remove_transaction(self, tx_hash):
@@ -334,13 +383,14 @@ class AddressSynchronizer(PrintError):
                     self.spent_outpoints[prevout_hash].pop(prevout_n, None)
                     if not self.spent_outpoints[prevout_hash]:
                         self.spent_outpoints.pop(prevout_hash)
-            else:  # expensive but always works
-                for prevout_hash, d in list(self.spent_outpoints.items()):
-                    for prevout_n, spending_txid in d.items():
-                        if spending_txid == tx_hash:
-                            self.spent_outpoints[prevout_hash].pop(prevout_n, None)
-                            if not self.spent_outpoints[prevout_hash]:
-                                self.spent_outpoints.pop(prevout_hash)
+            else:  # use the reverse index
+                for prevout_hash, prevout_n in self._spent_outpoints_by_txid.get(tx_hash, ()):
+                    d = self.spent_outpoints.get(prevout_hash, {})
+                    if d.get(prevout_n) == tx_hash:
+                        d.pop(prevout_n)
+                        if not d:
+                            self.spent_outpoints.pop(prevout_hash)
+            self._spent_outpoints_by_txid.pop(tx_hash, None)
             # Remove this tx itself; if nothing spends from it.
             # It is not so clear what to do if other txns spend from it, but it will be
             # removed when those other txns are removed.
@@ -352,10 +402,20 @@ class AddressSynchronizer(PrintError):
             tx = self.transactions.pop(tx_hash, None)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.txi.get(tx_hash, {}).keys(), self.txo.get(tx_hash, {}).keys()):
+            self._remove_tx_from_addr_io(tx_hash)
+            for d in (self.txi.pop(tx_hash, {}), self.txo.pop(tx_hash, {})):
+                for addr in d:
+                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+            self._txi_dirty.add(tx_hash)
+            self._txo_by_n.pop(tx_hash, None)
+            self._mine_epoch += 1
+
+    def _invalidate_balance_cache_for_tx(self, tx_hash):
+        # to be called whenever tx_hash moves between confirmed, unconfirmed
+        # and local, as that moves its coins between balance buckets
+        for d in (self.txi.get(tx_hash, {}), self.txo.get(tx_hash, {})):
+            for addr in d:
                 self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
-            self.txi.pop(tx_hash, None)
-            self.txo.pop(tx_hash, None)
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_unverified_tx(tx_hash, tx_height)
@@ -363,17 +423,28 @@ class AddressSynchronizer(PrintError):
 
     def receive_history_callback(self, addr, hist, tx_fees):
         with self.lock:
-            old_hist = self.get_address_history(addr)
-            for tx_hash, height in old_hist:
-                if (tx_hash, height) not in hist:
-                    # make tx local
-                    self.unverified_tx.pop(tx_hash, None)
-                    self.verified_tx.pop(tx_hash, None)
-                    if self.verifier:
-                        self.verifier.remove_spv_proof_for_tx(tx_hash)
+            old_set = set(self.get_address_history(addr))
+            new_set = set(hist)
+            for tx_hash, height in old_set - new_set:
+                # make tx local
+                self.unverified_tx.pop(tx_hash, None)
+                self.verified_tx.pop(tx_hash, None)
+                self._invalidate_balance_cache_for_tx(tx_hash)
+                if self.verifier:
+                    self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.history[addr] = hist
 
+        # Store fees
+        self.tx_fees.update(tx_fees)
+
+        if new_set == old_set:
+            # local history already matches the server's
+            return
+        # entries already in our local history at the same height have
+        # been added with addr being is_mine; only process the new ones
         for tx_hash, tx_height in hist:
+            if (tx_hash, tx_height) in old_set:
+                continue
             # add it in case it was previously unconfirmed
             self.add_unverified_tx(tx_hash, tx_height)
             # if addr is new, we have to recompute txi and txo
@@ -382,58 +453,84 @@ class AddressSynchronizer(PrintError):
                 continue
             self.add_transaction(tx_hash, tx, allow_unrelated=True)
 
-        # Store fees
-        self.tx_fees.update(tx_fees)
-
     @profiler
     def load_transactions(self):
         # load txi, txo, tx_fees
+        def parse_outpoint(ser):
+            prevout_hash, prevout_n = ser.split(':')
+            return prevout_hash, int(prevout_n)
         self.txi = self.storage.get('txi', {})
+        # txi in storage format, only re-serialized for dirty txids on save
+        self._txi_stored = self.storage.get('txi', {})
+        self._txi_dirty = set()
         for txid, d in list(self.txi.items()):
             for addr, lst in d.items():
-                self.txi[txid][addr] = set([tuple(x) for x in lst])
+                # outpoints are stored as 'prevout_hash:n' strings
+                self.txi[txid][addr] = set((parse_outpoint(ser), v) for ser, v in lst)
         self.txo = self.storage.get('txo', {})
+        # txid -> n -> (addr, value, is_coinbase); index of self.txo by output number
+        self._txo_by_n = {}
+        for txid, d in self.txo.items():
+            by_n = self._txo_by_n[txid] = {}
+            for addr, lst in d.items():
+                # rows are read back from json as lists; tuples are smaller
+                d[addr] = lst = tuple(tuple(x) for x in lst)
+                for n, v, is_cb in lst:
+                    by_n[n] = (addr, v, is_cb)
+        self._load_addr_io()
         self.tx_fees = self.storage.get('tx_fees', {})
         tx_list = self.storage.get('transactions', {})
-        # load transactions
+        # load transactions. note: Transaction only deserializes raw
+        # on first access of its inputs/outputs
         self.transactions = {}
         for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
             if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None:
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                continue
+            self.transactions[tx_hash] = Transaction(raw)
         # load spent_outpoints
         _spent_outpoints = self.storage.get('spent_outpoints', {})
         self.spent_outpoints = defaultdict(dict)
+        # spending txid -> set of (prevout_hash, prevout_n) it spends
+        self._spent_outpoints_by_txid = {}
         for prevout_hash, d in _spent_outpoints.items():
             for prevout_n_str, spending_txid in d.items():
                 prevout_n = int(prevout_n_str)
                 if spending_txid not in self.transactions:
                     continue
                 self.spent_outpoints[prevout_hash][prevout_n] = spending_txid
+                self._spent_outpoints_by_txid.setdefault(spending_txid, set()).add((prevout_hash, prevout_n))
 
     def get_depending_transactions(self, tx_hash):
         """Returns all (grand-)children of tx_hash in this wallet."""
         children = set()
-        for other_hash in self.spent_outpoints[tx_hash].values():
-            children.add(other_hash)
-            children |= self.get_depending_transactions(other_hash)
+        to_visit = [tx_hash]
+        while to_visit:
+            for other_hash in self.spent_outpoints.get(to_visit.pop(), {}).values():
+                if other_hash not in children:
+                    children.add(other_hash)
+                    to_visit.append(other_hash)
         return children
+
     @profiler
     def load_local_history(self):
         self._history_local = {}  # address -> set(txid)
-        for txid in itertools.chain(self.txi, self.txo):
-            self._add_tx_to_local_history(txid)
+        with self.transaction_lock:
+            for d in (self.txi, self.txo):
+                for txid, addrs in d.items():
+                    for addr in addrs:
+                        self._history_local.setdefault(addr, set()).add(txid)
 
     @profiler
     def check_history(self):
         save = False
-        hist_addrs_mine = list(filter(lambda k: self.is_mine(k), self.history.keys()))
-        hist_addrs_not_mine = list(filter(lambda k: not self.is_mine(k), self.history.keys()))
-        for addr in hist_addrs_not_mine:
-            self.history.pop(addr)
-            save = True
+        hist_addrs_mine = []
+        for addr in list(self.history.keys()):
+            if self.is_mine(addr):
+                hist_addrs_mine.append(addr)
+            else:
+                self.history.pop(addr)
+                save = True
         for addr in hist_addrs_mine:
             hist = self.history[addr]
             for tx_hash, tx_height in hist:
@@ -460,7 +557,16 @@ class AddressSynchronizer(PrintError):
             for k,v in self.transactions.items():
                 tx[k] = str(v)
             self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
+            # outpoints are (prevout_hash, prevout_n) in memory, strings on disk.
+            # only convert the entries that changed since the last save
+            for txid in self._txi_dirty:
+                d = self.txi.get(txid)
+                if d is None:
+                    self._txi_stored.pop(txid, None)
+                else:
+                    self._txi_stored[txid] = {addr: [('%s:%d' % ser, v) for ser, v in s] for addr, s in d.items()}
+            self._txi_dirty.clear()
+            self.storage.put('txi', self._txi_stored)
             self.storage.put('txo', self.txo)
             self.storage.put('tx_fees', self.tx_fees)
             self.storage.put('addr_history', self.history)
@@ -485,39 +591,56 @@ class AddressSynchronizer(PrintError):
         with self.lock:
             with self.transaction_lock:
                 self.txi = {}
+                self._txi_stored = {}
+                self._txi_dirty = set()
                 self.txo = {}
+                self._txo_by_n = {}
+                self._addr_received = {}
+                self._addr_sent = {}
                 self.tx_fees = {}
                 self.spent_outpoints = defaultdict(dict)
+                self._spent_outpoints_by_txid = {}
                 self.history = {}
                 self.verified_tx = {}
+                self._get_addr_balance_cache = {}
+                self._balance_maturity_heap = []
+                self._balance_maturity = {}
                 self.token_history = {}
                 self.tx_receipt = {}
                 self.token_txs = {}
                 self.transactions = {}
+                self._mine_epoch += 1
                 self.save_transactions()
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
-        with self.lock:
-            if tx_hash in self.verified_tx:
-                info = self.verified_tx[tx_hash]
-                return info.height, info.txpos
-            elif tx_hash in self.unverified_tx:
-                height = self.unverified_tx[tx_hash]
-                return (height, 0) if height > 0 else ((1e9 - height), 0)
-            else:
-                return (1e9+1, 0)
+        # lock-free, see _get_tx_height
+        height = self.unverified_tx.get(tx_hash)
+        info = self.verified_tx.get(tx_hash)
+        if height is None and info is None:
+            height = self.unverified_tx.get(tx_hash)
+        if info:
+            return info.height, info.txpos
+        elif height is not None:
+            return (height, 0) if height > 0 else ((1e9 - height), 0)
+        else:
+            return (1e9+1, 0)
 
     def with_local_height_cached(func):
         # get local height only once, as it's relatively expensive.
+        # tx heights are also cached for the duration of the call, as
+        # get_tx_height is called several times per tx and takes self.lock.
         # take care that nested calls work as expected
         def f(self, *args, **kwargs):
             orig_val = getattr(self.threadlocal_cache, 'local_height', None)
+            orig_tx_heights = getattr(self.threadlocal_cache, 'tx_heights', None)
             self.threadlocal_cache.local_height = orig_val or self.get_local_height()
+            self.threadlocal_cache.tx_heights = orig_tx_heights if orig_tx_heights is not None else {}
             try:
                 return func(self, *args, **kwargs)
             finally:
                 self.threadlocal_cache.local_height = orig_val
+                self.threadlocal_cache.tx_heights = orig_tx_heights
         return f
 
     @with_local_height_cached
@@ -527,26 +650,37 @@ class AddressSynchronizer(PrintError):
         if domain is None:
             domain = self.get_addresses()
         domain = set(domain)
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                delta = self.get_tx_delta(tx_hash, addr)
-                if delta is None or tx_deltas[tx_hash] is None:
-                    tx_deltas[tx_hash] = None
-                else:
-                    tx_deltas[tx_hash] += delta
+        # 1. Get the txs touching the domain, and compute the delta of a tx
+        #    as the sum of its deltas on domain addresses, in a single pass
+        #    over its txi/txo (rather than once per (address, tx) pair).
+        #    deltas are always known, as txi records the value of each input
+        tx_deltas = {}
+        with self.transaction_lock:
+            txi, txo, history_local = self.txi, self.txo, self._history_local
+            tx_hashes = set()
+            for addr in domain:
+                tx_hashes.update(history_local.get(addr, ()))
+            for tx_hash in tx_hashes:
+                delta = 0
+                for addr, d in txi.get(tx_hash, {}).items():
+                    if addr in domain:
+                        for n, v in d:
+                            delta -= v
+                for addr, d in txo.get(tx_hash, {}).items():
+                    if addr in domain:
+                        for n, v, cb in d:
+                            delta += v
+                tx_deltas[tx_hash] = delta
 
         # 2. create sorted history
+        #    keyed on (height, txpos) packed into a single int
         history = []
-        for tx_hash in tx_deltas:
-            delta = tx_deltas[tx_hash]
+        for tx_hash, delta in tx_deltas.items():
             tx_mined_status = self.get_tx_height(tx_hash)
-            history.append((tx_hash, tx_mined_status, delta))
+            height, txpos = self.get_txpos(tx_hash)
+            history.append(((int(height) << 32) | txpos, tx_hash, tx_mined_status, delta))
 
-        history.sort(key=lambda x: self.get_txpos(x[0]))
+        history.sort(key=itemgetter(0))
         history.reverse()
 
         # 3. add balance
@@ -554,48 +688,73 @@ class AddressSynchronizer(PrintError):
         balance = c + u + x
         h2 = []
         now = time.time()
-        for tx_hash, tx_mined_status, delta in history:
+        for _key, tx_hash, tx_mined_status, delta in history:
             if from_timestamp and (tx_mined_status.timestamp or now) < from_timestamp:
                 continue
             if to_timestamp and (tx_mined_status.timestamp or now) >= to_timestamp:
                 continue
             h2.append((tx_hash, tx_mined_status, delta, balance))
-            if balance is None or delta is None:
-                balance = None
-            else:
-                balance -= delta
+            balance -= delta
         h2.reverse()
 
         if not from_timestamp and not to_timestamp:
             # fixme: this may happen if history is incomplete
-            if balance not in [None, 0]:
+            if balance != 0:
                 self.print_error("Error: history not synchronized")
                 return []
         return h2
 
+    def _load_addr_io(self):
+        # address -> (txid, n) -> (value, is_coinbase), for all outputs in txo
+        self._addr_received = {}
+        # address -> outpoint -> spending txid, for all inputs in txi
+        self._addr_sent = {}
+        for txid, d in self.txo.items():
+            for addr, lst in d.items():
+                received = self._addr_received.setdefault(addr, {})
+                for n, v, is_cb in lst:
+                    received[(txid, n)] = (v, is_cb)
+        for txid, d in self.txi.items():
+            for addr, s in d.items():
+                sent = self._addr_sent.setdefault(addr, {})
+                for ser, v in s:
+                    sent[ser] = txid
+
+    def _remove_tx_from_addr_io(self, txid):
+        with self.transaction_lock:
+            for addr, s in self.txi.get(txid, {}).items():
+                sent = self._addr_sent.get(addr, {})
+                for ser, v in s:
+                    if sent.get(ser) == txid:
+                        del sent[ser]
+            for addr, lst in self.txo.get(txid, {}).items():
+                received = self._addr_received.get(addr, {})
+                for n, v, is_cb in lst:
+                    received.pop((txid, n), None)
+
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
-            for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
-                cur_hist = self._history_local.get(addr, set())
-                cur_hist.add(txid)
-                self._history_local[addr] = cur_hist
+            for d in (self.txi, self.txo):
+                for addr in d.get(txid, ()):
+                    self._history_local.setdefault(addr, set()).add(txid)
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
-            for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
-                cur_hist = self._history_local.get(addr, set())
-                try:
-                    cur_hist.remove(txid)
-                except KeyError:
-                    pass
-                else:
-                    self._history_local[addr] = cur_hist
+            for d in (self.txi, self.txo):
+                for addr in d.get(txid, ()):
+                    cur_hist = self._history_local.get(addr)
+                    if cur_hist is not None:
+                        cur_hist.discard(txid)
 
     def add_unverified_tx(self, tx_hash, tx_height):
         if tx_hash in self.verified_tx:
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
+                    # keep it as unconfirmed rather than turning it local;
+                    # add before removing, for lock-free readers
+                    self.unverified_tx[tx_hash] = tx_height
                     self.verified_tx.pop(tx_hash)
+                    self._invalidate_balance_cache_for_tx(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
@@ -608,16 +767,26 @@ class AddressSynchronizer(PrintError):
 
     def add_verified_tx(self, tx_hash: str, info: VerifiedTxInfo):
         # Remove from the unverified map and add to the verified map
+        # add before removing, so that lock-free readers never see neither
         with self.lock:
-            self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info
-        tx_mined_status = self.get_tx_height(tx_hash)
-        self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
+            self.unverified_tx.pop(tx_hash, None)
+            # the notification is sent by notify_verified_txs
+            self._pending_verified_notif.append(tx_hash)
+
+    def notify_verified_txs(self):
+        """Send a single 'verified' callback for all txs verified since
+        the last call. Called periodically by the verifier."""
+        with self.lock:
+            if not self._pending_verified_notif:
+                return
+            txids, self._pending_verified_notif = self._pending_verified_notif, []
+        verified = [(tx_hash, self.get_tx_height(tx_hash)) for tx_hash in txids]
+        self.network.trigger_callback('verified', self, verified)
 
     def get_unverified_txs(self):
         '''Returns a map from tx hash to transaction height'''
-        with self.lock:
-            return dict(self.unverified_tx)  # copy
+        return dict(self.unverified_tx)  # copy; atomic under the GIL
 
     def undo_verifications(self, blockchain, height):
         '''Used by the verifier when a reorg has happened'''
@@ -628,7 +797,6 @@ class AddressSynchronizer(PrintError):
                 if tx_height >= height:
                     header = blockchain.read_header(tx_height)
                     if not header or hash_header(header) != info.header_hash:
-                        self.verified_tx.pop(tx_hash, None)
                         # NOTE: we should add these txns to self.unverified_tx,
                         # but with what height?
                         # If on the new fork after the reorg, the txn is at the
@@ -638,7 +806,9 @@ class AddressSynchronizer(PrintError):
                         # unverified_tx, it will turn into local. So we put it
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
+                        # add before removing, for lock-free readers
                         self.unverified_tx[tx_hash] = tx_height
+                        self.verified_tx.pop(tx_hash, None)
                         txs.add(tx_hash)
         return txs
 
@@ -647,25 +817,42 @@ class AddressSynchronizer(PrintError):
         cached_local_height = getattr(self.threadlocal_cache, 'local_height', None)
         if cached_local_height is not None:
             return cached_local_height
+        return self._read_local_height()
+
+    def _read_local_height(self):
         return self.network.get_local_height() if self.network else self.storage.get('stored_height', 0)
 
     def get_tx_height(self, tx_hash: str) -> TxMinedInfo:
-        with self.lock:
-            verified_tx_info = self.verified_tx.get(tx_hash, None)
-            if verified_tx_info:
-                conf = max(self.get_local_height() - verified_tx_info.height + 1, 0)
-                return TxMinedInfo(
-                    height=verified_tx_info.height,
-                    conf=conf,
-                    header_hash=verified_tx_info.header_hash,
-                    timestamp=verified_tx_info.timestamp,
-                )
-            elif tx_hash in self.unverified_tx:
-                height = self.unverified_tx[tx_hash]
-                return TxMinedInfo(height=height, conf=0)
-            else:
-                # local transaction
-                return TxMinedInfo(height=TX_HEIGHT_LOCAL, conf=0)
+        cached_tx_heights = getattr(self.threadlocal_cache, 'tx_heights', None)
+        if cached_tx_heights is None:
+            return self._get_tx_height(tx_hash)
+        tx_mined_status = cached_tx_heights.get(tx_hash)
+        if tx_mined_status is None:
+            tx_mined_status = cached_tx_heights[tx_hash] = self._get_tx_height(tx_hash)
+        return tx_mined_status
+
+    def _get_tx_height(self, tx_hash: str) -> TxMinedInfo:
+        # No lock: single dict lookups are atomic. Writers moving a tx
+        # between unverified_tx and verified_tx insert before popping, so
+        # if neither lookup finds it, a move to unverified_tx may have run
+        # in between; look there once more before calling it local.
+        height = self.unverified_tx.get(tx_hash)
+        verified_tx_info = self.verified_tx.get(tx_hash)
+        if height is None and verified_tx_info is None:
+            height = self.unverified_tx.get(tx_hash)
+        if verified_tx_info:
+            conf = max(self.get_local_height() - verified_tx_info.height + 1, 0)
+            return TxMinedInfo(
+                height=verified_tx_info.height,
+                conf=conf,
+                header_hash=verified_tx_info.header_hash,
+                timestamp=verified_tx_info.timestamp,
+            )
+        elif height is not None:
+            return TxMinedInfo(height=height, conf=0)
+        else:
+            # local transaction
+            return TxMinedInfo(height=TX_HEIGHT_LOCAL, conf=0)
 
     def set_up_to_date(self, up_to_date):
         with self.lock:
@@ -682,62 +869,71 @@ class AddressSynchronizer(PrintError):
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
 
-    @with_transaction_lock
+    # get_tx_delta and get_tx_value do not take transaction_lock: entries
+    # are only added to txi/txo once complete, and containers that
+    # add_transaction may still extend are copied before iterating
+    # (tuple() of a builtin container is atomic under the GIL)
+
     def get_tx_delta(self, tx_hash, address):
         """"effect of tx on address"""
         delta = 0
         # substract the value of coins sent from address
-        d = self.txi.get(tx_hash, {}).get(address, [])
-        for n, v in d:
+        for n, v in tuple(self.txi.get(tx_hash, {}).get(address, ())):
             delta -= v
         # add the value of the coins received at address
-        d = self.txo.get(tx_hash, {}).get(address, [])
-        for n, v, cb in d:
+        for n, v, cb in self.txo.get(tx_hash, {}).get(address, ()):
             delta += v
         return delta
 
-    @with_transaction_lock
     def get_tx_value(self, txid):
         """effect of tx on the entire domain"""
         delta = 0
-        for addr, d in self.txi.get(txid, {}).items():
-            for n, v in d:
+        for d in tuple(self.txi.get(txid, {}).values()):
+            for n, v in tuple(d):
                 delta -= v
-        for addr, d in self.txo.get(txid, {}).items():
+        for d in tuple(self.txo.get(txid, {}).values()):
             for n, v, cb in d:
                 delta += v
         return delta
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
+        # only complete txs are cached, as their inputs and outputs are final
+        epoch = self._mine_epoch
+        cached = self._wallet_delta_cache.get(tx)
+        if cached is not None and cached[0] == epoch:
+            return cached[1]
+        result = self._get_wallet_delta(tx)
+        if tx.is_complete():
+            self._wallet_delta_cache[tx] = (epoch, result)
+        return result
+
+    def _get_wallet_delta(self, tx):
         is_relevant = False  # "related to wallet?"
         is_mine = False
         is_pruned = False
         is_partial = False
         v_in = v_out = v_out_mine = 0
+        is_mine_address = self.is_mine
+        get_txin_address = self.get_txin_address
+        txo_by_n = self._txo_by_n
         for txin in tx.inputs():
-            addr = self.get_txin_address(txin)
-            if self.is_mine(addr):
+            addr = get_txin_address(txin)
+            if is_mine_address(addr):
                 is_mine = True
                 is_relevant = True
-                d = self.txo.get(txin['prevout_hash'], {}).get(addr, [])
-                for n, v, cb in d:
-                    if n == txin['prevout_n']:
-                        value = v
-                        break
-                else:
-                    value = None
-                if value is None:
+                prevout = txo_by_n.get(txin['prevout_hash'], {}).get(txin['prevout_n'])
+                if prevout is None or prevout[0] != addr:
                     is_pruned = True
                 else:
-                    v_in += value
+                    v_in += prevout[1]
             else:
                 is_partial = True
         if not is_mine:
             is_partial = False
         for o in tx.outputs():
             v_out += o.value
-            if self.is_mine(o.address):
+            if is_mine_address(o.address):
                 v_out_mine += o.value
                 is_relevant = True
         if is_pruned:
@@ -761,72 +957,112 @@ class AddressSynchronizer(PrintError):
         return is_relevant, is_mine, v, fee
 
     def get_addr_io(self, address):
+        # we need self.transaction_lock but get_tx_height will take self.lock
+        # so we need to take that too here, to enforce order of locks
         with self.lock, self.transaction_lock:
-            h = self.get_address_history(address)
             received = {}
+            for txo, (v, is_cb) in self._addr_received.get(address, {}).items():
+                received[txo] = (self.get_tx_height(txo[0]).height, v, is_cb)
             sent = {}
-            for tx_hash, height in h:
-                l = self.txo.get(tx_hash, {}).get(address, [])
-                for n, v, is_cb in l:
-                    received[tx_hash + ':%d'%n] = (height, v, is_cb)
-            for tx_hash, height in h:
-                l = self.txi.get(tx_hash, {}).get(address, [])
-                for txi, v in l:
-                    sent[txi] = height
+            for txi, tx_hash in self._addr_sent.get(address, {}).items():
+                sent[txi] = self.get_tx_height(tx_hash).height
         return received, sent
 
+    def _get_addr_unspent(self, address):
+        """Returns a list of (txo, height, value, is_coinbase) of the
+        unspent outputs of address."""
+        with self.lock, self.transaction_lock:
+            spent = self._addr_sent.get(address, {})
+            return [(txo, self.get_tx_height(txo[0]).height, v, is_cb)
+                    for txo, (v, is_cb) in self._addr_received.get(address, {}).items()
+                    if txo not in spent]
+
+    @staticmethod
+    def _make_utxo(address, txo, tx_height, value, is_cb):
+        prevout_hash, prevout_n = txo
+        return {
+            'address':address,
+            'value':value,
+            'prevout_n':prevout_n,
+            'prevout_hash':prevout_hash,
+            'height':tx_height,
+            'coinbase':is_cb
+        }
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
         out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
+        for txo, tx_height, value, is_cb in self._get_addr_unspent(address):
+            out[txo] = self._make_utxo(address, txo, tx_height, value, is_cb)
         return out
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
-        return sum([v for height, v, is_cb in received.values()])
+        # only the values are needed; no sent map or heights
+        with self.transaction_lock:
+            return sum(v for v, is_cb in self._addr_received.get(address, {}).values())
 
-    @with_local_height_cached
     def get_addr_balance(self, address):
         """return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
         """
-        cached_value = self._get_addr_balance_cache.get(address)
-        if cached_value:
+        cached_value = self._get_addr_balance_cache.get(address, _MISSING)
+        if cached_value is not _MISSING:
             return cached_value
-        received, sent = self.get_addr_io(address)
+        return self._compute_addr_balance(address)
+
+    def _compute_addr_balance(self, address):
+        # a single pass over the outputs of address; unlike get_addr_io,
+        # heights are only looked up for received coins and their spenders.
+        # Invalidations are made under self.lock or self.transaction_lock,
+        # so the result is computed and cached under both, from the tip and
+        # tx heights as they are now rather than as an enclosing
+        # with_local_height_cached call saw them.
         c = u = x = 0
-        local_height = self.get_local_height()
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > local_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
+        maturity = None  # lowest height at which an unmatured coinbase matures
+        with self.lock, self.transaction_lock:
+            local_height = self._read_local_height()
+            verified_tx = self.verified_tx
+            unverified_tx = self.unverified_tx
+
+            def get_tx_height(tx_hash):
+                info = verified_tx.get(tx_hash)
+                if info:
+                    return info.height
+                return unverified_tx.get(tx_hash, TX_HEIGHT_LOCAL)
+
+            sent = self._addr_sent.get(address, {})
+            for txo, (v, is_cb) in self._addr_received.get(address, {}).items():
+                tx_height = get_tx_height(txo[0])
+                if is_cb and tx_height + COINBASE_MATURITY > local_height:
+                    x += v
+                    # unconfirmed coinbases are invalidated by add_transaction
+                    # once they get mined
+                    if tx_height > 0 and (maturity is None or tx_height + COINBASE_MATURITY < maturity):
+                        maturity = tx_height + COINBASE_MATURITY
+                elif tx_height > 0:
+                    c += v
                 else:
-                    u -= v
-        result = c, u, x
-        # cache result.
-        # Cache needs to be invalidated if a transaction is added to/
-        # removed from history; or on new blocks (maturity...)
-        self._get_addr_balance_cache[address] = result
+                    u += v
+                spending_txid = sent.get(txo)
+                if spending_txid is not None:
+                    if get_tx_height(spending_txid) > 0:
+                        c -= v
+                    else:
+                        u -= v
+            result = c, u, x
+            # cache result.
+            # Cache needs to be invalidated if a transaction is added to/
+            # removed from history; or on new blocks (maturity...)
+            if maturity is not None and maturity <= self._balance_cache_height:
+                # the tip has moved past maturity; on_blockchain_updated
+                # will not see this address again
+                return result
+            self._get_addr_balance_cache[address] = result
+            if maturity is not None:
+                scheduled = self._balance_maturity.get(address)
+                if scheduled is None or maturity < scheduled:
+                    self._balance_maturity[address] = maturity
+                    heapq.heappush(self._balance_maturity_heap, (maturity, address))
         return result
 
     @with_local_height_cached
@@ -836,18 +1072,20 @@ class AddressSynchronizer(PrintError):
             domain = self.get_addresses()
         domain = set(domain)
         if excluded:
-            domain = set(domain) - excluded
+            domain -= excluded
+        # coinbase outputs above this height are not mature yet
+        maturity_cutoff = self.get_local_height() - COINBASE_MATURITY
         for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos.values():
-                if confirmed_only and x['height'] <= 0:
+            # filter before building the coin dicts
+            for txo, tx_height, value, is_cb in self._get_addr_unspent(addr):
+                if confirmed_only and tx_height <= 0:
                     continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                if mature and is_cb and tx_height > maturity_cutoff:
                     continue
-                coins.append(x)
-                continue
+                coins.append(self._make_utxo(addr, txo, tx_height, value, is_cb))
         return coins
 
+    @with_local_height_cached
     def get_balance(self, domain=None):
         if domain is None:
             domain = self.get_addresses()
@@ -865,17 +1103,21 @@ class AddressSynchronizer(PrintError):
         return len(h) != 0
 
     def is_empty(self, address):
-        c, u, x = self.get_addr_balance(address)
-        return c+u+x == 0
+        # c+u+x is zero iff every (non-zero) coin received was spent,
+        # whatever the heights; no need to compute the balance
+        with self.transaction_lock:
+            sent = self._addr_sent.get(address, {})
+            for txo, (v, is_cb) in self._addr_received.get(address, {}).items():
+                if v and txo not in sent:
+                    return False
+        return True
 
     @profiler
     def load_token_txs(self):
         token_tx_list = self.storage.get('token_txs', {})
-        # token_hist_txids = reduce(lambda x, y: x+y, list([[y[0] for y in x] for x in self.token_history.values()]))
-        if self.token_history:
-            token_hist_txids = [x2[0] for x2 in reduce(lambda x1, y1: x1+y1, self.token_history.values())]
-        else:
-            token_hist_txids = []
+        token_hist_txids = set()
+        for hist in self.token_history.values():
+            token_hist_txids.update(x[0] for x in hist)
         self.token_txs = {}
         for tx_hash, raw in token_tx_list.items():
             if tx_hash in token_hist_txids:
@@ -886,12 +1128,13 @@ class AddressSynchronizer(PrintError):
     def check_token_history(self):
         # remove not mine and not subscribe token history
         save = False
-        hist_keys_not_mine = list(filter(lambda k: not self.is_mine(k.split('_')[1]), self.token_history.keys()))
-        hist_keys_not_subscribe = list(filter(lambda k: k not in self.tokens, self.token_history.keys()))
-        for key in set(hist_keys_not_mine).union(hist_keys_not_subscribe):
+        to_drop = [key for key in self.token_history
+                   if key not in self.tokens or not self.is_mine(key.split('_')[1])]
+        for key in to_drop:
             hist = self.token_history.pop(key)
             for txid, height, log_index in hist:
-                self.token_txs.pop(txid)
+                # several keys may refer to the same tx
+                self.token_txs.pop(txid, None)
             save = True
         if save:
             self.save_transactions()
@@ -932,56 +1175,57 @@ class AddressSynchronizer(PrintError):
 
     def delete_token(self, key):
         with self.token_lock:
-            if key in self.tokens:
-                self.tokens.pop(key)
-            if key in self.token_history:
-                self.token_history.pop(key)
+            # Tokens.pop ignores missing keys, and only saves on removal
+            self.tokens.pop(key)
+            self.token_history.pop(key, None)
 
     def get_token_history(self, contract_addr=None, bind_addr=None, from_timestamp=None, to_timestamp=None):
         with self.lock, self.token_lock:
             h = []  # from, to, amount, token, txid, height, conf, timestamp, call_index, log_index
             keys = []
             for token_key in self.tokens.keys():
-                if contract_addr and contract_addr in token_key \
-                        or bind_addr and bind_addr in token_key \
+                token_contract_addr, token_bind_addr = token_key.split('_')
+                if contract_addr and contract_addr == token_contract_addr \
+                        or bind_addr and bind_addr == token_bind_addr \
                         or not bind_addr and not contract_addr:
-                    keys.append(token_key)
-            for key in keys:
-                contract_addr, bind_addr = key.split('_')
+                    keys.append((token_key, token_contract_addr, token_bind_addr))
+            get_tx_height, tx_receipt = self.get_tx_height, self.tx_receipt
+            for key, contract_addr, bind_addr in keys:
+                token = self.tokens[key]
+                # user bind address, as it appears in the transfer topics
+                _, hash160b = b58_address_to_hash160(bind_addr)
+                hash160 = bh2u(hash160b).zfill(64)
                 for txid, height, log_index in self.token_history.get(key, []):
-                    status = self.get_tx_height(txid)
+                    status = get_tx_height(txid)
                     height, conf, timestamp = status.height, status.conf, status.timestamp
-                    for call_index, contract_call in enumerate(self.tx_receipt.get(txid, [])):
+                    for call_index, contract_call in enumerate(tx_receipt.get(txid, [])):
                         logs = contract_call.get('log', [])
-                        if len(logs) > log_index:
-                            log = logs[log_index]
-
-                            # check contarct address
-                            if contract_addr != log.get('address', ''):
-                                print('contract address mismatch')
-                                continue
-
-                            # check topic name
-                            topics = log.get('topics', [])
-                            if len(topics) < 3:
-                                print('not enough topics')
-                                continue
-                            if topics[0] != TOKEN_TRANSFER_TOPIC:
-                                print('topic mismatch')
-                                continue
-
-                            # check user bind address
-                            _, hash160b = b58_address_to_hash160(bind_addr)
-                            hash160 = bh2u(hash160b).zfill(64)
-                            if hash160 not in topics:
-                                print('address mismatch')
-                                continue
-                            amount = int(log.get('data'), 16)
-                            from_addr = topics[1][-40:]
-                            to_addr = topics[2][-40:]
-                            h.append(
-                                (from_addr, to_addr, amount, self.tokens[key], txid,
-                                 height, conf, timestamp, call_index, log_index))
-                        else:
+                        if len(logs) <= log_index:
+                            continue
+                        log = logs[log_index]
+                        topics = log.get('topics', [])
+
+                        # check contarct address
+                        if contract_addr != log.get('address', ''):
+                            self.print_error('contract address mismatch', txid)
+                            continue
+
+                        # check topic name
+                        if len(topics) < 3:
+                            self.print_error('not enough topics', txid)
+                            continue
+                        if topics[0] != TOKEN_TRANSFER_TOPIC:
+                            self.print_error('topic mismatch', txid)
+                            continue
+
+                        # check user bind address
+                        if hash160 != topics[1] and hash160 != topics[2]:
+                            self.print_error('address mismatch', txid)
                             continue
-            return sorted(h, key=itemgetter(5, 8, 9), reverse=True)
\ No newline at end of file
+                        amount = int(log.get('data'), 16)
+                        # sort on (height, call_index, log_index), packed into a single int
+                        sort_key = (((height << 20) | call_index) << 20) | log_index
+                        h.append((sort_key, (topics[1][-40:], topics[2][-40:], amount, token, txid,
+                                             height, conf, timestamp, call_index, log_index)))
+            h.sort(key=itemgetter(0), reverse=True)
+            return [row for sort_key, row in h]
\ No newline at end of file
@@ -47,12 +47,17 @@ def CKD_priv(k, c, n):
 
 
 def _CKD_priv(k, c, s, is_prime):
-    try:
-        keypair = ecc.ECPrivkey(k)
-    except ecc.InvalidECPointException as e:
-        raise QtumException('Impossible xprv (not within curve order)') from e
-    cK = keypair.get_public_key_bytes(compressed=True)
-    data = bytes([0]) + k + s if is_prime else cK + s
+    if is_prime:
+        # hardened: hash the private key itself; no need for k*G
+        if not ecc.is_secret_within_curve_range(k):
+            raise QtumException('Impossible xprv (not within curve order)')
+        data = bytes([0]) + k + s
+    else:
+        try:
+            keypair = ecc.ECPrivkey(k)
+        except ecc.InvalidECPointException as e:
+            raise QtumException('Impossible xprv (not within curve order)') from e
+        data = keypair.get_public_key_bytes(compressed=True) + s
     I = hmac_oneshot(c, data, hashlib.sha512)
     I_left = ecc.string_to_number(I[0:32])
     k_n = (I_left + ecc.string_to_number(k)) % ecc.CURVE_ORDER
@@ -118,9 +123,13 @@ class InvalidMasterKeyVersionBytes(QtumException): pass
 
 
 def deserialize_xkey(xkey, prv, *, net=None):
+    return deserialize_raw_xkey(DecodeBase58Check(xkey), prv, net=net)
+
+
+def deserialize_raw_xkey(xkey: bytes, prv, *, net=None):
+    """Like deserialize_xkey, for an already Base58Check-decoded key."""
     if net is None:
         net = constants.net
-    xkey = DecodeBase58Check(xkey)
     if len(xkey) != 78:
         raise QtumException('Invalid length for extended key: {}'
                                .format(len(xkey)))
@@ -173,15 +182,17 @@ def xpub_from_xprv(xprv):
     return serialize_xpub(xtype, c, cK, depth, fingerprint, child_number)
 
 
-def bip32_root(seed, xtype):
+def bip32_root_xprv(seed, xtype):
     I = hmac_oneshot(b"Bitcoin seed", seed, hashlib.sha512)
     master_k = I[0:32]
     master_c = I[32:]
-    # create xprv first, as that will check if master_k is within curve order
-    xprv = serialize_xprv(xtype, master_c, master_k)
-    cK = ecc.ECPrivkey(master_k).get_public_key_bytes(compressed=True)
-    xpub = serialize_xpub(xtype, master_c, cK)
-    return xprv, xpub
+    # serialize_xprv checks that master_k is within curve order
+    return serialize_xprv(xtype, master_c, master_k)
+
+
+def bip32_root(seed, xtype):
+    xprv = bip32_root_xprv(seed, xtype)
+    return xprv, xpub_from_xprv(xprv)
 
 
 def xpub_from_pubkey(xtype, cK):
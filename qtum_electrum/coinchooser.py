@@ -22,8 +22,11 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import hashlib
 from collections import defaultdict
-from math import floor, log10
+from functools import lru_cache
+from itertools import accumulate
+from operator import attrgetter, or_
 from typing import NamedTuple, List
 
 from .bitcoin import sha256, COIN, TYPE_ADDRESS, is_address
@@ -38,34 +41,57 @@ from .util import NotEnoughFunds, PrintError
 # to spend.  This prevents attacks on users by malicious or stale
 # servers.
 class PRNG:
-    def __init__(self, seed):
-        self.sha = sha256(seed)
-        self.pool = bytearray()
+    def __init__(self, seed, *, hashed=False):
+        # hashed: seed is already the sha256 digest of the seed
+        self.sha = seed if hashed else sha256(seed)
+        self.pool = b''
+        self.pos = 0
 
     def get_bytes(self, n):
-        while len(self.pool) < n:
-            self.pool.extend(self.sha)
-            self.sha = sha256(self.sha)
-        result, self.pool = self.pool[:n], self.pool[n:]
-        return result
+        pos = self.pos
+        if pos + n > len(self.pool):
+            chunks = [self.pool[pos:]]
+            have = len(chunks[0])
+            while have < n:
+                chunks.append(self.sha)
+                have += len(self.sha)
+                self.sha = sha256(self.sha)
+            self.pool = b''.join(chunks)
+            pos = 0
+        self.pos = pos + n
+        return self.pool[pos:pos + n]
 
     def randint(self, start, end):
         # Returns random integer in [start, end)
         n = end - start
-        r = 0
-        p = 1
-        while p < n:
-            r = self.get_bytes(1)[0] + (r << 8)
-            p = p << 8
+        # as many big-endian bytes as it takes to cover n
+        r = int.from_bytes(self.get_bytes(((n - 1).bit_length() + 7) // 8), 'big')
         return start + (r % n)
 
     def choice(self, seq):
         return seq[self.randint(0, len(seq))]
 
     def shuffle(self, x):
-        for i in reversed(range(1, len(x))):
+        # fetch the bytes for every swap at once; this consumes exactly what
+        # calling randint(0, i+1) for each i would
+        indices = range(len(x) - 1, 0, -1)
+        if len(x) <= 256:
+            # the common case: one byte per swap
+            for i, r in zip(indices, self.get_bytes(len(indices))):
+                j = r % (i + 1)
+                x[i], x[j] = x[j], x[i]
+            return
+        sizes = [(i.bit_length() + 7) // 8 for i in indices]
+        pool = self.get_bytes(sum(sizes))
+        pos = 0
+        for i, size in zip(indices, sizes):
             # pick an element in x[:i+1] with which to exchange x[i]
-            j = self.randint(0, i+1)
+            if size == 1:
+                r = pool[pos]
+            else:
+                r = int.from_bytes(pool[pos:pos + size], 'big')
+            pos += size
+            j = r % (i + 1)
             x[i], x[j] = x[j], x[i]
 
 
@@ -76,6 +102,48 @@ class Bucket(NamedTuple):
     coins: List[dict]
     min_height: int
     witness: bool
+    num_legacy_inputs: int  # 0 for a witness bucket, else len(coins)
+    max_adj_height: int  # height of the youngest coin, unconfirmed counting as youngest
+
+
+def adj_height(height):
+    # Unconfirmed coins are young, not old
+    return 99999999 if height <= 0 else height
+
+
+def bucket_weight_sums(buckets):
+    '''Return the (weight, has_witness, num_legacy_inputs) totals of
+    buckets, which is all get_tx_weight needs to know about them'''
+    weight = num_legacy_inputs = 0
+    has_witness = False
+    for bucket in buckets:
+        weight += bucket.weight
+        has_witness |= bucket.witness
+        num_legacy_inputs += bucket.num_legacy_inputs
+    return weight, has_witness, num_legacy_inputs
+
+
+def first_sufficient_prefix(buckets, sufficient_funds, selected=()) -> list:
+    '''Append buckets to selected one at a time until they are enough to
+    pay for the transaction, and return them; None if they never are.
+    Running totals are kept so that each step is constant time.'''
+    selected = list(selected)
+    bucket_value_sum = sum(bucket.value for bucket in selected)
+    weight, has_witness, num_legacy_inputs = bucket_weight_sums(selected)
+    for bucket in buckets:
+        selected.append(bucket)
+        bucket_value_sum += bucket.value
+        weight += bucket.weight
+        has_witness |= bucket.witness
+        num_legacy_inputs += bucket.num_legacy_inputs
+        if sufficient_funds(selected, bucket_value_sum=bucket_value_sum,
+                            weight_sums=(weight, has_witness, num_legacy_inputs)):
+            return selected
+    return None
+
+
+def _bucket_index(bkts, desc):
+    return next((i for i, bkt in enumerate(bkts) if bkt.desc == desc), None)
 
 
 def strip_unneeded(bkts, sufficient_funds, exception_addr=None) -> list:
@@ -87,20 +155,25 @@ def strip_unneeded(bkts, sufficient_funds, exception_addr=None) -> list:
         # none of the buckets are needed
         return []
     bkts = sorted(bkts, key=lambda bkt: bkt.value, reverse=True)
-    bucket_value_sum = 0
 
     # move the exception bucket to the top
     if exception_addr:
-        for i in range(len(bkts)):
-            if bkts[i].desc == exception_addr:
-                exception_bucket = bkts[i]
-                del bkts[i]
-                bkts.insert(0, exception_bucket)
-                break
+        i = _bucket_index(bkts, exception_addr)
+        if i is not None:
+            bkts.insert(0, bkts.pop(i))
+
+    # prefix sums let each prefix be checked on totals alone, without
+    # building a prefix list.  Sufficiency is not monotone in the prefix
+    # length (a bucket worth less than its fee can tip a longer prefix
+    # back under), so take the first sufficient prefix in order.
+    cum_value = list(accumulate(bkt.value for bkt in bkts))
+    cum_weight = list(accumulate(bkt.weight for bkt in bkts))
+    cum_witness = list(accumulate((bkt.witness for bkt in bkts), or_))
+    cum_legacy = list(accumulate(bkt.num_legacy_inputs for bkt in bkts))
 
     for i in range(len(bkts)):
-        bucket_value_sum += (bkts[i]).value
-        if sufficient_funds(bkts[:i+1], bucket_value_sum=bucket_value_sum):
+        if sufficient_funds(None, bucket_value_sum=cum_value[i],
+                            weight_sums=(cum_weight[i], cum_witness[i], cum_legacy[i])):
             return bkts[:i+1]
     raise Exception("keeping all buckets is still not enough")
 
@@ -111,11 +184,28 @@ def strip_unneeded_utxo(bkts, sufficient_funds):
     bucket = bkts[0]
     desc = bucket.desc
     coins = []
+    # grow the bucket one coin at a time with running totals, rather than
+    # re-estimating every coin in make_Bucket for each prefix; earlier coins
+    # only need estimating again the one time the bucket turns segwit
+    estimated_input_weight = Transaction.estimated_input_weight
+    witness = False
+    weight = value = 0
+    min_height = bucket.coins[0]['height']
+    max_adj_height = 0
 
     for coin in bucket.coins:
         coins.append(coin)
-        new_bucket = make_Bucket(desc, coins)
-        if sufficient_funds([new_bucket], bucket_value_sum=new_bucket.value):
+        if not witness and Transaction.is_segwit_input(coin, guess_for_address=True):
+            witness = True
+            weight = sum(estimated_input_weight(c, witness) for c in coins)
+        else:
+            weight += estimated_input_weight(coin, witness)
+        value += coin['value']
+        min_height = min(min_height, coin['height'])
+        max_adj_height = max(max_adj_height, adj_height(coin['height']))
+        new_bucket = Bucket(desc, weight, value, coins, min_height, witness,
+                            0 if witness else len(coins), max_adj_height)
+        if sufficient_funds([new_bucket], bucket_value_sum=value):
             return [new_bucket, ]
     return [bucket, ]
 
@@ -124,11 +214,22 @@ def make_Bucket(desc, coins):
     witness = any(Transaction.is_segwit_input(coin, guess_for_address=True) for coin in coins)
     # note that we're guessing whether the tx uses segwit based
     # on this single bucket
-    weight = sum(Transaction.estimated_input_weight(coin, witness)
-                 for coin in coins)
-    value = sum(coin['value'] for coin in coins)
-    min_height = min(coin['height'] for coin in coins)
-    return Bucket(desc, weight, value, coins, min_height, witness)
+    # everything else in one pass over the coins
+    estimated_input_weight = Transaction.estimated_input_weight
+    weight = value = 0
+    min_height = coins[0]['height']
+    max_adj_height = 0
+    for coin in coins:
+        weight += estimated_input_weight(coin, witness)
+        value += coin['value']
+        height = coin['height']
+        if height < min_height:
+            min_height = height
+        height = adj_height(height)
+        if height > max_adj_height:
+            max_adj_height = height
+    return Bucket(desc, weight, value, coins, min_height, witness,
+                  0 if witness else len(coins), max_adj_height)
 
 
 class CoinChooserBase(PrintError):
@@ -146,7 +247,7 @@ class CoinChooserBase(PrintError):
         return list(map(make_Bucket, buckets.keys(), buckets.values()))
 
     def penalty_func(self, tx):
-        def penalty(candidate):
+        def penalty(candidate, cutoff=None):
             return 0
         return penalty
 
@@ -154,7 +255,7 @@ class CoinChooserBase(PrintError):
         # Break change up if bigger than max_change
         output_amounts = [o.value for o in tx.outputs()]
         # Don't split change of less than 0.02 BTC
-        max_change = max(max(output_amounts) * 1.25, 0.02 * COIN)
+        max_change = max(max(output_amounts) * 5 // 4, COIN // 50)
 
         # Use N change outputs
         for n in range(1, count + 1):
@@ -166,8 +267,13 @@ class CoinChooserBase(PrintError):
         # Get a handle on the precision of the output amounts; round our
         # change to look similar
         def trailing_zeroes(val):
-            s = str(val)
-            return len(s) - len(s.rstrip('0'))
+            if val == 0:
+                return 1  # as many as str(0) has
+            n = 0
+            while val % 10 == 0:
+                val //= 10
+                n += 1
+            return n
 
         zeroes = [trailing_zeroes(i) for i in output_amounts]
         min_zeroes = min(zeroes)
@@ -183,10 +289,15 @@ class CoinChooserBase(PrintError):
         remaining = change_amount
         amounts = []
         while n > 1:
-            average = remaining / n
-            amount = self.p.randint(int(average * 0.7), int(average * 1.3))
-            precision = min(self.p.choice(zeroes), int(floor(log10(amount))))
-            amount = int(round(amount, -precision))
+            # between 70% and 130% of the average, in whole satoshis
+            amount = self.p.randint(remaining * 7 // (10 * n), remaining * 13 // (10 * n))
+            precision = min(self.p.choice(zeroes), len(str(amount)) - 1)
+            # round half to even at that precision, like round() does
+            unit = 10 ** precision
+            q, r = divmod(amount, unit)
+            if 2 * r > unit or (2 * r == unit and q % 2):
+                q += 1
+            amount = q * unit
             amounts.append(amount)
             remaining -= amount
             n -= 1
@@ -229,9 +340,13 @@ class CoinChooserBase(PrintError):
         Note: fee_estimator expects virtual bytes
         """
 
-        # Deterministic randomness from coins
-        utxos = [c['prevout_hash'] + str(c['prevout_n']) for c in coins]
-        self.p = PRNG(''.join(sorted(utxos)))
+        # Deterministic randomness from coins.  Feeding the sorted outpoints
+        # to sha256 one by one gives the same seed as joining them first.
+        seed = hashlib.sha256()
+        for prevout_hash, prevout_n in sorted((c['prevout_hash'], str(c['prevout_n'])) for c in coins):
+            seed.update(prevout_hash.encode('utf8'))
+            seed.update(prevout_n.encode('utf8'))
+        self.p = PRNG(seed.digest(), hashed=True)
 
         # Copy the ouputs so when adding change we don't modify "outputs"
         tx = Transaction.from_io(inputs[:], outputs[:])
@@ -243,33 +358,32 @@ class CoinChooserBase(PrintError):
         base_weight = tx.estimated_weight()
         spent_amount = tx.output_value()
 
+        # the same few weights come up over and over while choosing
+        @lru_cache(maxsize=4096)
         def fee_estimator_w(weight):
             return fee_estimator(Transaction.virtual_size_from_weight(weight))
 
-        def get_tx_weight(buckets):
-            total_weight = base_weight + sum(bucket.weight for bucket in buckets)
-            is_segwit_tx = any(bucket.witness for bucket in buckets)
-            if is_segwit_tx:
-                total_weight += 2  # marker and flag
-                # non-segwit inputs were previously assumed to have
-                # a witness of '' instead of '00' (hex)
-                # note that mixed legacy/segwit buckets are already ok
-                num_legacy_inputs = sum((not bucket.witness) * len(bucket.coins)
-                                        for bucket in buckets)
-                total_weight += num_legacy_inputs
-
-            return total_weight
-
-        def sufficient_funds(buckets, *, bucket_value_sum):
+        def get_tx_weight(buckets, weight_sums=None):
+            if weight_sums is None:
+                weight_sums = bucket_weight_sums(buckets)
+            weight, is_segwit_tx, num_legacy_inputs = weight_sums
+            # a segwit tx adds 2 for marker and flag, and 1 per legacy input:
+            # non-segwit inputs were previously assumed to have
+            # a witness of '' instead of '00' (hex)
+            # note that mixed legacy/segwit buckets are already ok
+            return base_weight + weight + is_segwit_tx * (2 + num_legacy_inputs)
+
+        def sufficient_funds(buckets, *, bucket_value_sum, weight_sums=None):
             '''Given a list of buckets, return True if it has enough
-            value to pay for the transaction'''
+            value to pay for the transaction.  Callers that keep running
+            bucket_weight_sums() can pass them, and buckets may then be None'''
             # assert bucket_value_sum == sum(bucket.value for bucket in buckets)  # expensive!
             total_input = input_value + bucket_value_sum
             if total_input < spent_amount:  # shortcut for performance
                 return False
             # note re performance: so far this was constant time
-            # what follows is linear in len(buckets)
-            total_weight = get_tx_weight(buckets)
+            # what follows is linear in len(buckets) unless weight_sums is given
+            total_weight = get_tx_weight(buckets, weight_sums)
             return total_input >= spent_amount + fee_estimator_w(total_weight)
 
         # Collect the coins into buckets, choose a subset of the buckets
@@ -311,33 +425,52 @@ class CoinChooserRandom(CoinChooserBase):
         '''Returns a list of bucket sets.'''
         if not buckets:
             raise NotEnoughFunds()
+        # candidates are kept as bitmasks over the indices into buckets
         candidates = set()
 
         # Add all singletons
-        for n, bucket in enumerate(buckets):
-            if sufficient_funds([bucket], bucket_value_sum=bucket.value):
-                candidates.add((n, ))
+        singletons = [n for n, bucket in enumerate(buckets)
+                      if sufficient_funds([bucket], bucket_value_sum=bucket.value)]
+        candidates.update(1 << n for n in singletons)
 
-        # And now some random ones
-        attempts = min(100, (len(buckets) - 1) * 10 + 1)
+        # When there are far more buckets than needed, only shuffle among
+        # the largest ones (and the sufficient singletons); a greedy pick by
+        # value tells roughly how many are needed
         permutation = list(range(len(buckets)))
+        by_value = sorted(permutation, key=lambda n: buckets[n].value, reverse=True)
+        greedy = first_sufficient_prefix((buckets[n] for n in by_value), sufficient_funds)
+        if greedy is not None and len(permutation) > 3 * len(greedy):
+            permutation = sorted(set(by_value[:3 * len(greedy)]).union(singletons))
+
+        # And now some random ones.  A permutation can only come up with
+        # something new by starting from a bucket that is not sufficient
+        # on its own, so scale the attempts by the number of those
+        attempts = min(100, max(1, (len(permutation) - len(candidates) - 1) * 10 + 1))
         for i in range(attempts):
             # Get a random permutation of the buckets, and
             # incrementally combine buckets until sufficient
             self.p.shuffle(permutation)
-            bkts = []
-            bucket_value_sum = 0
-            for count, index in enumerate(permutation):
-                bucket = buckets[index]
-                bkts.append(bucket)
-                bucket_value_sum += bucket.value
-                if sufficient_funds(bkts, bucket_value_sum=bucket_value_sum):
-                    candidates.add(tuple(sorted(permutation[:count + 1])))
-                    break
-            else:
-                raise NotEnoughFunds()
+            bkts = first_sufficient_prefix((buckets[index] for index in permutation),
+                                           sufficient_funds)
+            if bkts is None and len(permutation) < len(buckets):
+                # the largest buckets did not add up in this order; search
+                # among all of them from now on
+                permutation = list(range(len(buckets)))
+                continue
+            if bkts is None:
+                # sufficiency is not monotone (a bucket worth less than its
+                # fee can tip a prefix back under), so this order may fail
+                # even though some of the buckets pay; keep what was found
+                break
+            mask = 0
+            for index in permutation[:len(bkts)]:
+                mask |= 1 << index
+            candidates.add(mask)
+        if not candidates:
+            raise NotEnoughFunds()
 
-        candidates = [[buckets[n] for n in c] for c in candidates]
+        candidates = [[bucket for n, bucket in enumerate(buckets) if mask >> n & 1]
+                      for mask in candidates]
         return [strip_unneeded(c, sufficient_funds) for c in candidates]
 
     def bucket_candidates_prefer_confirmed(self, buckets, sufficient_funds):
@@ -352,26 +485,39 @@ class CoinChooserRandom(CoinChooserBase):
         are not enough, tries to use the next type but while also selecting
         all buckets of all previous types.
         """
-        conf_buckets = [bkt for bkt in buckets if bkt.min_height > 0]
-        unconf_buckets = [bkt for bkt in buckets if bkt.min_height == 0]
-        other_buckets = [bkt for bkt in buckets if bkt.min_height < 0]
+        # confirmed, unconfirmed and other buckets, with their value sums
+        bucket_sets = [[], [], []]
+        value_sums = [0, 0, 0]
+        for bkt in buckets:
+            i = 0 if bkt.min_height > 0 else 1 if bkt.min_height == 0 else 2
+            bucket_sets[i].append(bkt)
+            value_sums[i] += bkt.value
 
-        bucket_sets = [conf_buckets, unconf_buckets, other_buckets]
         already_selected_buckets = []
         already_selected_buckets_value_sum = 0
+        already_selected_weight_sums = bucket_weight_sums([])
 
-        for bkts_choose_from in bucket_sets:
+        for bkts_choose_from, value_sum in zip(bucket_sets, value_sums):
             try:
-                def sfunds(bkts, *, bucket_value_sum):
+                def sfunds(bkts, *, bucket_value_sum, weight_sums=None):
                     bucket_value_sum += already_selected_buckets_value_sum
-                    return sufficient_funds(already_selected_buckets + bkts,
-                                            bucket_value_sum=bucket_value_sum)
+                    if weight_sums is None:
+                        bkts = already_selected_buckets + bkts
+                    else:
+                        weight, has_witness, num_legacy_inputs = already_selected_weight_sums
+                        weight_sums = (weight + weight_sums[0],
+                                       has_witness or weight_sums[1],
+                                       num_legacy_inputs + weight_sums[2])
+                        bkts = None
+                    return sufficient_funds(bkts, bucket_value_sum=bucket_value_sum,
+                                            weight_sums=weight_sums)
 
                 candidates = self.bucket_candidates_any(bkts_choose_from, sfunds)
                 break
             except NotEnoughFunds:
                 already_selected_buckets += bkts_choose_from
-                already_selected_buckets_value_sum += sum(bucket.value for bucket in bkts_choose_from)
+                already_selected_buckets_value_sum += value_sum
+                already_selected_weight_sums = bucket_weight_sums(already_selected_buckets)
         else:
             raise NotEnoughFunds()
 
@@ -380,10 +526,15 @@ class CoinChooserRandom(CoinChooserBase):
 
     def choose_buckets(self, buckets, sufficient_funds, penalty_func, sender=None):
         candidates = self.bucket_candidates_prefer_confirmed(buckets, sufficient_funds)
-        penalties = [penalty_func(cand) for cand in candidates]
-        winner = candidates[penalties.index(min(penalties))]
+        # the first candidate with the lowest penalty wins; penalty_func
+        # may give up on a candidate as soon as it is worse than the best
+        winner, min_penalty = candidates[0], penalty_func(candidates[0])
+        for cand in candidates[1:]:
+            penalty = penalty_func(cand, min_penalty)
+            if penalty < min_penalty:
+                winner, min_penalty = cand, penalty
         self.print_error("Bucket sets:", len(buckets))
-        self.print_error("Winning penalty:", min(penalties))
+        self.print_error("Winning penalty:", min_penalty)
         return winner
 
 
@@ -406,8 +557,12 @@ class CoinChooserPrivacy(CoinChooserRandom):
         max_change = max(o.value for o in tx.outputs()) * 1.33
         spent_amount = sum(o.value for o in tx.outputs())
 
-        def penalty(buckets):
+        def penalty(buckets, cutoff=None):
+            # every term is non-negative, so once badness exceeds cutoff
+            # the rest need not be computed
             badness = len(buckets) - 1
+            if cutoff is not None and badness > cutoff:
+                return float('inf')
             total_input = sum(bucket.value for bucket in buckets)
             # FIXME "change" here also includes fees
             change = float(total_input - spent_amount)
@@ -435,19 +590,11 @@ class CoinChooserOldestFirst(CoinChooserBase):
 
     def choose_buckets(self, buckets, sufficient_funds, penalty_func, sender=None):
         '''Spend the oldest buckets first.'''
-        # Unconfirmed coins are young, not old
-        adj_height = lambda height: 99999999 if height <= 0 else height
-        buckets.sort(key = lambda b: max(adj_height(coin['height'])
-                                         for coin in b.coins))
-        selected = []
-        bucket_value_sum = 0
-        for bucket in buckets:
-            selected.append(bucket)
-            bucket_value_sum += bucket.value
-            if sufficient_funds(selected, bucket_value_sum=bucket_value_sum):
-                return strip_unneeded(selected, sufficient_funds)
-        else:
+        buckets.sort(key=attrgetter('max_adj_height'))
+        selected = first_sufficient_prefix(buckets, sufficient_funds)
+        if selected is None:
             raise NotEnoughFunds()
+        return strip_unneeded(selected, sufficient_funds)
 
 
 class CoinChooserQtum(CoinChooserBase):
@@ -456,35 +603,26 @@ class CoinChooserQtum(CoinChooserBase):
 
     def choose_buckets(self, buckets, sufficient_funds, penalty_func, sender=None):
         '''Spend the oldest buckets first.'''
-        # Unconfirmed coins are young, not old
-        adj_height = lambda height: 99999999 if height <= 0 else height
-        buckets.sort(key=lambda b: max(adj_height(coin['height'])
-                                       for coin in b.coins))
+        buckets.sort(key=attrgetter('max_adj_height'))
         selected = []
         bucket_value_sum = 0
 
         if sender:
             # put sender bucket to selected first
-            for i in range(len(buckets)):
-                bucket = buckets[i]
-                if bucket.desc == sender:
-                    del buckets[i]
-                    selected.append(bucket)
-                    bucket_value_sum += bucket.value
-                    # check if it's already enough
-                    if sufficient_funds(selected, bucket_value_sum=bucket_value_sum):
-                        return strip_unneeded_utxo(selected, sufficient_funds)
-                    break
-            if len(selected) == 0:
+            i = _bucket_index(buckets, sender)
+            if i is None:
                 raise Exception('choose_buckets - sender address has no utxo')
-
-        for bucket in buckets:
+            bucket = buckets.pop(i)
             selected.append(bucket)
             bucket_value_sum += bucket.value
+            # check if it's already enough
             if sufficient_funds(selected, bucket_value_sum=bucket_value_sum):
-                return strip_unneeded(selected, sufficient_funds, sender)
-        else:
+                return strip_unneeded_utxo(selected, sufficient_funds)
+
+        selected = first_sufficient_prefix(buckets, sufficient_funds, selected)
+        if selected is None:
             raise NotEnoughFunds()
+        return strip_unneeded(selected, sufficient_funds, sender)
 
 
 COIN_CHOOSERS = {'Privacy': CoinChooserPrivacy,
@@ -31,7 +31,8 @@ from typing import Union
 
 import pyaes
 
-from .util import assert_bytes, InvalidPassword, to_bytes, to_string, WalletFileException
+from .util import (assert_bytes, InvalidPassword, to_bytes, to_string, WalletFileException,
+                   print_error)
 from .i18n import _
 
 
@@ -41,6 +42,18 @@ except:
     AES = None
 
 
+_warned_pyaes_fallback = False
+
+
+def _warn_pyaes_fallback():
+    # pyaes is pure python; pycryptodomex uses AES-NI where the CPU has it.
+    # warn on first use rather than at import, once verbosity is known
+    global _warned_pyaes_fallback
+    if not _warned_pyaes_fallback:
+        _warned_pyaes_fallback = True
+        print_error('[crypto] warning: pycryptodomex not available, falling back to pyaes')
+
+
 class InvalidPadding(Exception):
     pass
 
@@ -70,6 +83,7 @@ def aes_encrypt_with_iv(key: bytes, iv: bytes, data: bytes) -> bytes:
     if AES:
         e = AES.new(key, AES.MODE_CBC, iv).encrypt(data)
     else:
+        _warn_pyaes_fallback()
         aes_cbc = pyaes.AESModeOfOperationCBC(key, iv=iv)
         aes = pyaes.Encrypter(aes_cbc, padding=pyaes.PADDING_NONE)
         e = aes.feed(data) + aes.feed()  # empty aes.feed() flushes buffer
@@ -82,6 +96,7 @@ def aes_decrypt_with_iv(key: bytes, iv: bytes, data: bytes) -> bytes:
         cipher = AES.new(key, AES.MODE_CBC, iv)
         data = cipher.decrypt(data)
     else:
+        _warn_pyaes_fallback()
         aes_cbc = pyaes.AESModeOfOperationCBC(key, iv=iv)
         aes = pyaes.Decrypter(aes_cbc, padding=pyaes.PADDING_NONE)
         data = aes.feed(data) + aes.feed()  # empty aes.feed() flushes buffer
@@ -36,7 +36,8 @@ from ecdsa.util import string_to_number, number_to_string
 
 from .util import bfh, bh2u, assert_bytes, print_error, to_bytes, InvalidPassword, profiler
 from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
-from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
+from .ecc_fast import (do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1,
+                       is_using_fast_ecc)
 
 
 do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
@@ -52,6 +53,48 @@ def point_at_infinity():
     return ECPubkey(None)
 
 
+_generator_table = None  # _generator_table[i][j] = j * 16**i * G
+
+
+def _get_generator_table():
+    global _generator_table
+    if _generator_table is None:
+        table = []
+        base = generator_secp256k1
+        for i in range(64):
+            row = [ecdsa.ellipticcurve.INFINITY, base]
+            for j in range(2, 16):
+                row.append(row[-1] + base)
+            table.append(row)
+            base = row[15] + base
+        _generator_table = table
+    return _generator_table
+
+
+def _generator_mul(scalar: int):
+    # scalar * G as a python-ecdsa point, for 0 < scalar < CURVE_ORDER
+    if is_using_fast_ecc():
+        return generator_secp256k1 * scalar
+    point = ecdsa.ellipticcurve.INFINITY
+    for row in _get_generator_table():
+        if not scalar:
+            break
+        digit = scalar & 15
+        if digit:
+            point = point + row[digit]
+        scalar >>= 4
+    return point
+
+
+def fixed_base_mul(scalar: int) -> 'ECPubkey':
+    """Return scalar * G.  libsecp256k1 has its own tables for this; without
+    it, add up precomputed 4-bit windows instead of doubling 256 times."""
+    scalar %= CURVE_ORDER
+    if not scalar:
+        return generator() * scalar
+    return ECPubkey.from_point(_generator_mul(scalar))
+
+
 def sig_string_from_der_sig(der_sig, order=CURVE_ORDER):
     r, s = ecdsa.util.sigdecode_der(der_sig, order)
     return ecdsa.util.sigencode_string(r, s, order)
@@ -341,7 +384,7 @@ class ECPrivkey(ECPubkey):
             raise InvalidECPointException('Invalid secret scalar (not within curve order)')
         self.secret_scalar = secret
 
-        point = generator_secp256k1 * secret
+        point = _generator_mul(secret)
         super().__init__(point_to_ser(point))
         self._privkey = ecdsa.ecdsa.Private_key(self._pubkey, secret)
 
@@ -25,13 +25,16 @@
 # SOFTWARE.
 
 from unicodedata import normalize
+from collections import OrderedDict
+from functools import lru_cache, wraps
 import hashlib
+import struct
 from typing import Tuple
 from . import bitcoin, ecc, constants, bip32
 from .qtum import (deserialize_privkey, serialize_privkey,
                    public_key_to_p2pkh)
 from .bip32 import (bip32_public_derivation, deserialize_xpub, CKD_pub,
-                    bip32_root, deserialize_xprv, bip32_private_derivation,
+                    bip32_root_xprv, deserialize_xprv, bip32_private_derivation,
                     bip32_private_key, bip32_derivation, BIP32_PRIME,
                     is_xpub, is_xprv, CKD_priv)
 from .ecc import string_to_number, number_to_string
@@ -41,8 +44,35 @@ from .util import (PrintError, InvalidPassword, WalletFileException,
 from .mnemonic import Mnemonic, load_wordlist, seed_type, is_seed
 
 
+def cached_derive_pubkey(func):
+    """Memoize derive_pubkey(for_change, n) on the keystore, keeping the
+    PUBKEY_CACHE_SIZE most recently used results.  Entries are keyed by the
+    master public key as well, so replacing it cannot serve stale keys."""
+    @wraps(func)
+    def derive_pubkey(self, for_change, n):
+        key = (self.get_master_public_key(), for_change, n)
+        cache = self._pubkey_cache
+        try:
+            pubkey = cache[key]
+            cache.move_to_end(key)
+            return pubkey
+        except KeyError:
+            pass
+        pubkey = cache[key] = func(self, for_change, n)
+        if len(cache) > PUBKEY_CACHE_SIZE:
+            cache.popitem(last=False)
+        return pubkey
+    return derive_pubkey
+
+
+PUBKEY_CACHE_SIZE = 4096
+
+
 class KeyStore(PrintError):
 
+    def __init__(self):
+        self._pubkey_cache = OrderedDict()  # see cached_derive_pubkey
+
     def has_seed(self):
         return False
 
@@ -67,7 +97,8 @@ class KeyStore(PrintError):
                 continue
             x_signatures = txin['signatures']
             signatures = [sig for sig in x_signatures if sig]
-            if len(signatures) == num_sig:
+            needed = num_sig - len(signatures)
+            if needed <= 0:
                 # input is complete
                 continue
             for k, x_pubkey in enumerate(txin['x_pubkeys']):
@@ -78,6 +109,9 @@ class KeyStore(PrintError):
                 if not derivation:
                     continue
                 keypairs[x_pubkey] = derivation
+                needed -= 1
+                if needed == 0:
+                    break
         return keypairs
 
     def can_sign(self, tx):
@@ -114,10 +148,10 @@ class Software_KeyStore(KeyStore):
             return
         # Raise if password is not correct.
         self.check_password(password)
-        # Add private keys
+        # Add private keys; the password was checked above
         keypairs = self.get_tx_derivations(tx)
         for k, v in keypairs.items():
-            keypairs[k] = self.get_private_key(v, password)
+            keypairs[k] = self.get_private_key(v, password, skip_password_check=True)
         # Sign
         if keypairs:
             tx.sign(keypairs)
@@ -155,7 +189,7 @@ class Imported_KeyStore(Software_KeyStore):
         return True
 
     def check_password(self, password):
-        pubkey = list(self.keypairs.keys())[0]
+        pubkey = next(iter(self.keypairs))
         self.get_private_key(pubkey, password)
 
     def import_privkey(self, sec, password):
@@ -170,19 +204,21 @@ class Imported_KeyStore(Software_KeyStore):
     def delete_imported_key(self, key):
         self.keypairs.pop(key)
 
-    def get_private_key(self, pubkey, password):
+    def get_private_key(self, pubkey, password, *, skip_password_check=False):
         sec = pw_decode(self.keypairs[pubkey], password, version=self.pw_hash_version)
         txin_type, privkey, compressed = deserialize_privkey(sec)
         # this checks the password
-        if pubkey != ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed):
+        if not skip_password_check and \
+                pubkey != ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed):
             raise InvalidPassword()
         return privkey, compressed
 
     def get_pubkey_derivation(self, x_pubkey):
-        if x_pubkey[0:2] in ['02', '03', '04']:
-            if x_pubkey in self.keypairs.keys():
+        prefix = x_pubkey[0:2]
+        if prefix in ('02', '03', '04'):
+            if x_pubkey in self.keypairs:
                 return x_pubkey
-        elif x_pubkey[0:2] == 'fd':
+        elif prefix == 'fd':
             addr = bitcoin.script_to_address(x_pubkey[2:])
             if addr in self.addresses:
                 return self.addresses[addr].get('pubkey')
@@ -246,10 +282,14 @@ class Xpub:
         self.xpub = None
         self.xpub_receive = None
         self.xpub_change = None
+        # xpub -> deserialize_xpub(xpub), for the master and branch xpubs
+        self._xpub_nodes = {}
+        self._xpub_raw = None  # (xpub, DecodeBase58Check(xpub))
 
     def get_master_public_key(self):
         return self.xpub
 
+    @cached_derive_pubkey
     def derive_pubkey(self, for_change, n):
 
         # m / 44'/ 88' / 0' / for_change / n
@@ -260,19 +300,31 @@ class Xpub:
                 self.xpub_change = xpub
             else:
                 self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        _, _, _, _, c, cK = self.get_xpub_node(xpub)
+        return self.get_pubkey_from_node(c, cK, (n,))
+
+    def get_xpub_node(self, xpub):
+        node = self._xpub_nodes.get(xpub)
+        if node is None:
+            node = self._xpub_nodes[xpub] = deserialize_xpub(xpub)
+        return node
 
     @classmethod
     def get_pubkey_from_xpub(cls, xpub, sequence):
         _, _, _, _, c, cK = deserialize_xpub(xpub)
+        return cls.get_pubkey_from_node(c, cK, sequence)
+
+    @classmethod
+    def get_pubkey_from_node(cls, c, cK, sequence):
         for i in sequence:
             cK, c = CKD_pub(cK, c, i)
         public_key = bh2u(cK)
         return public_key
 
     def get_xpubkey(self, c, i):
-        s = ''.join(map(lambda x: bitcoin.int_to_hex(x,2), (c, i)))
-        return 'ff' + bh2u(bitcoin.DecodeBase58Check(self.xpub)) + s
+        if self._xpub_raw is None or self._xpub_raw[0] != self.xpub:
+            self._xpub_raw = (self.xpub, bitcoin.DecodeBase58Check(self.xpub))
+        return 'ff' + bh2u(self._xpub_raw[1] + struct.pack('<HH', c, i))
 
 
     @classmethod
@@ -280,14 +332,9 @@ class Xpub:
         assert pubkey[0:2] == 'ff'
         pk = bfh(pubkey)
         pk = pk[1:]
+        assert len(pk) == 82
         xkey = bitcoin.EncodeBase58Check(pk[0:78])
-        dd = pk[78:]
-        s = []
-        while dd:
-            n = int(bitcoin.rev_hex(bh2u(dd[0:2])), 16)
-            dd = dd[2:]
-            s.append(n)
-        assert len(s) == 2
+        s = list(struct.unpack('<HH', pk[78:]))
         return xkey, s
 
     def get_pubkey_derivation(self, x_pubkey):
@@ -310,6 +357,19 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         self.xprv = d.get('xprv')
         self.derivation = d.get('derivation', '')
 
+    @property
+    def xpub(self):
+        # derived from the xprv passed to add_xprv on first use
+        if self._xprv_for_xpub is not None:
+            self._xpub = bip32.xpub_from_xprv(self._xprv_for_xpub)
+            self._xprv_for_xpub = None
+        return self._xpub
+
+    @xpub.setter
+    def xpub(self, xpub):
+        self._xpub = xpub
+        self._xprv_for_xpub = None
+
     def format_seed(self, seed):
         return ' '.join(seed.split())
 
@@ -325,7 +385,7 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
 
     def check_password(self, password):
         xprv = pw_decode(self.xprv, password, version=self.pw_hash_version)
-        if deserialize_xprv(xprv)[4] != deserialize_xpub(self.xpub)[4]:
+        if deserialize_xprv(xprv)[4] != self.get_xpub_node(self.xpub)[4]:
             raise InvalidPassword()
 
     def update_password(self, old_password, new_password):
@@ -348,15 +408,16 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
 
     def add_xprv(self, xprv):
         self.xprv = xprv
-        self.xpub = bip32.xpub_from_xprv(xprv)
+        self._xpub = None
+        self._xprv_for_xpub = xprv
 
     def add_xprv_from_seed(self, bip32_seed, xtype, derivation):
-        xprv, xpub = bip32_root(bip32_seed, xtype)
+        xprv = bip32_root_xprv(bip32_seed, xtype)
         xprv, xpub = bip32_private_derivation(xprv, "m/", derivation)
         self.derivation = derivation
         self.add_xprv(xprv)
 
-    def get_private_key(self, sequence, password):
+    def get_private_key(self, sequence, password, *, skip_password_check=False):
         xprv = self.get_master_private_key(password)
         _, _, _, _, c, k = deserialize_xprv(xprv)
         pk = bip32_private_key(sequence, k, c)
@@ -383,6 +444,7 @@ class Mobile_KeyStore(BIP32_KeyStore):
     def can_import(self):
         return False
 
+    @cached_derive_pubkey
     def derive_pubkey(self, for_change, n):
         master_xprv = self.get_master_private_key(None)
         sub_xprv, sub_xpub = bip32_private_derivation(master_xprv, "", "/{}'".format(n))
@@ -401,11 +463,12 @@ class Mobile_KeyStore(BIP32_KeyStore):
         pk = self.get_privatekey_from_xprv(sub_xprv, ())
         return pk, True
 
-    def get_private_key(self, pubkey, password):
+    def get_private_key(self, pubkey, password, *, skip_password_check=False):
         sec = pw_decode(self.keypairs[pubkey], password, version=self.pw_hash_version)
         txin_type, privkey, compressed = deserialize_privkey(sec)
         # this checks the password
-        if pubkey != ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed):
+        if not skip_password_check and \
+                pubkey != ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed):
             raise InvalidPassword()
         return privkey, compressed
 
@@ -419,10 +482,11 @@ class Mobile_KeyStore(BIP32_KeyStore):
         return txin_type, pubkey
 
     def get_pubkey_derivation(self, x_pubkey):
-        if x_pubkey[0:2] in ['02', '03', '04']:
-            if x_pubkey in self.keypairs.keys():
+        prefix = x_pubkey[0:2]
+        if prefix in ('02', '03', '04'):
+            if x_pubkey in self.keypairs:
                 return x_pubkey
-        elif x_pubkey[0:2] == 'fd':
+        elif prefix == 'fd':
             addr = bitcoin.script_to_address(x_pubkey[2:])
             if addr in self.addresses:
                 return self.addresses[addr].get('pubkey')
@@ -445,6 +509,7 @@ class Qt_Core_Keystore(BIP32_KeyStore):
         d['ext_master_xprv'] = self.ext_master_xprv
         return d
 
+    @cached_derive_pubkey
     def derive_pubkey(self, for_change, n):
         master_xprv = self.get_master_private_key(None)
         sub_xprv, sub_xpub = bip32_private_derivation(master_xprv, "", "/{}'".format(n))
@@ -457,7 +522,7 @@ class Qt_Core_Keystore(BIP32_KeyStore):
             cK, c = CKD_priv(cK, c, i)
         return cK
 
-    def get_private_key(self, sequence, password):
+    def get_private_key(self, sequence, password, *, skip_password_check=False):
         master_xprv = self.get_master_private_key(password)
         sub_xprv, sub_xpub = bip32_private_derivation(master_xprv, "", "/{}'".format(sequence[1]))
         pk = self.get_privatekey_from_xprv(sub_xprv, ())
@@ -471,6 +536,7 @@ class Old_KeyStore(Deterministic_KeyStore):
     def __init__(self, d):
         Deterministic_KeyStore.__init__(self, d)
         self.mpk = d.get('mpk')
+        self._mpk_point = None  # (mpk, ECPubkey of mpk)
 
     def get_hex_seed(self, password):
         return pw_decode(self.seed, password, version=self.pw_hash_version).encode('utf8')
@@ -518,8 +584,9 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def stretch_key(self, seed):
         x = seed
-        for i in range(100000):
-            x = hashlib.sha256(x + seed).digest()
+        sha256 = hashlib.sha256
+        for _ in range(100000):
+            x = sha256(x + seed).digest()
         return string_to_number(x)
 
     @classmethod
@@ -528,25 +595,32 @@ class Old_KeyStore(Deterministic_KeyStore):
 
 
     @classmethod
-    def get_pubkey_from_mpk(self, mpk, for_change, n):
+    def get_pubkey_from_mpk(self, mpk, for_change, n, master_public_key=None):
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecc.ECPubkey(bfh('04' + mpk))
-        public_key = master_public_key + z * ecc.generator()
+        if master_public_key is None:
+            master_public_key = ecc.ECPubkey(bfh('04' + mpk))
+        public_key = master_public_key + ecc.fixed_base_mul(z)
         return public_key.get_public_key_hex(compressed=False)
 
+    @cached_derive_pubkey
     def derive_pubkey(self, for_change, n):
-        return self.get_pubkey_from_mpk(self.mpk, for_change, n)
+        # parse and validate the mpk point only once per mpk
+        if self._mpk_point is None or self._mpk_point[0] != self.mpk:
+            self._mpk_point = (self.mpk, ecc.ECPubkey(bfh('04' + self.mpk)))
+        return self.get_pubkey_from_mpk(self.mpk, for_change, n, self._mpk_point[1])
 
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % ecc.CURVE_ORDER
         pk = number_to_string(secexp, ecc.CURVE_ORDER)
         return pk
 
-    def get_private_key(self, sequence, password):
+    def get_private_key(self, sequence, password, *, skip_password_check=False):
         seed = self.get_hex_seed(password)
-        self.check_seed(seed)
+        if skip_password_check:
+            secexp = self.stretch_key(seed)
+        else:
+            secexp = self.check_seed(seed)
         for_change, n = sequence
-        secexp = self.stretch_key(seed)
         pk = self.get_private_key_from_stretched_exponent(for_change, n, secexp)
         return pk, False
 
@@ -557,31 +631,42 @@ class Old_KeyStore(Deterministic_KeyStore):
         if master_public_key != bfh(self.mpk):
             print_error('invalid password (mpk)', self.mpk, bh2u(master_public_key))
             raise InvalidPassword()
+        return secexp
 
     def check_password(self, password):
         seed = self.get_hex_seed(password)
         self.check_seed(seed)
 
+    def sign_transaction(self, tx, password):
+        if self.is_watching_only():
+            return
+        # stretching costs 100000 sha256 rounds, so do it once per tx.
+        # secexp is the master private key: only keep it for this call
+        seed = self.get_hex_seed(password)
+        secexp = self.check_seed(seed)  # raises if password is not correct
+        try:
+            keypairs = self.get_tx_derivations(tx)
+            for k, (for_change, n) in keypairs.items():
+                keypairs[k] = self.get_private_key_from_stretched_exponent(for_change, n, secexp), False
+            if keypairs:
+                tx.sign(keypairs)
+        finally:
+            del secexp, seed
+
     def get_master_public_key(self):
         return self.mpk
 
     def get_xpubkey(self, for_change, n):
-        s = ''.join(map(lambda x: bitcoin.int_to_hex(x,2), (for_change, n)))
-        return 'fe' + self.mpk + s
+        return 'fe' + self.mpk + bh2u(struct.pack('<HH', for_change, n))
 
     @classmethod
     def parse_xpubkey(self, x_pubkey):
         assert x_pubkey[0:2] == 'fe'
         pk = x_pubkey[2:]
         mpk = pk[0:128]
-        dd = pk[128:]
-        s = []
-        while dd:
-            n = int(bitcoin.rev_hex(dd[0:4]), 16)
-            dd = dd[4:]
-            s.append(n)
-        assert len(s) == 2
-        return mpk, s
+        dd = bfh(pk[128:])
+        assert len(dd) == 4
+        return mpk, list(struct.unpack('<HH', dd))
 
     def get_pubkey_derivation(self, x_pubkey):
         if x_pubkey[0:2] != 'fe':
@@ -677,43 +762,63 @@ class Hardware_KeyStore(KeyStore, Xpub):
         return super().ready_to_sign() and self.has_usable_connection_with_device()
 
 
+def _is_ascii(s: str) -> bool:
+    # str.isascii() needs python 3.7
+    try:
+        s.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _normalize_nfkd(s: str) -> str:
+    # ASCII text is already in NFKD form
+    return s if _is_ascii(s) else normalize('NFKD', s)
+
+
 def bip39_normalize_passphrase(passphrase):
-    return normalize('NFKD', passphrase or '')
+    return _normalize_nfkd(passphrase or '')
 
 
 def bip39_to_seed(mnemonic, passphrase):
-    import hashlib, hmac
     PBKDF2_ROUNDS = 2048
-    mnemonic = normalize('NFKD', ' '.join(mnemonic.split()))
+    mnemonic = _normalize_nfkd(' '.join(mnemonic.split()))
     passphrase = bip39_normalize_passphrase(passphrase)
     return hashlib.pbkdf2_hmac('sha512', mnemonic.encode('utf-8'),
         b'mnemonic' + passphrase.encode('utf-8'), iterations=PBKDF2_ROUNDS)
 
 
+@lru_cache(maxsize=None)
+def _get_wordlist_index(filename):
+    # word -> position; loaded from disk once per wordlist
+    return {w: i for i, w in enumerate(load_wordlist(filename))}
+
+
 # returns tuple (is_checksum_valid, is_wordlist_valid)
 def bip39_is_checksum_valid(mnemonic: str) -> Tuple[bool, bool]:
     """Test checksum of bip39 mnemonic assuming English wordlist.
     Returns tuple (is_checksum_valid, is_wordlist_valid)
     """
-    words = [ normalize('NFKD', word) for word in mnemonic.split() ]
+    if _is_ascii(mnemonic):
+        words = mnemonic.split()
+    else:
+        words = [ normalize('NFKD', word) for word in mnemonic.split() ]
     words_len = len(words)
-    wordlist = load_wordlist("english.txt")
-    n = len(wordlist)
+    index = _get_wordlist_index("english.txt")
+    assert len(index) == 2048
+    # each word is 11 bits of the big-endian integer
     i = 0
-    words.reverse()
-    while words:
-        w = words.pop()
-        try:
-            k = wordlist.index(w)
-        except ValueError:
+    for w in words:
+        k = index.get(w)
+        if k is None:
             return False, False
-        i = i*n + k
+        i = (i << 11) | k
     if words_len not in [12, 15, 18, 21, 24]:
         return False, True
     checksum_length = 11 * words_len // 33  # num bits
     entropy_length = 32 * checksum_length  # num bits
     entropy = i >> checksum_length
-    checksum = i % 2**checksum_length
+    checksum = i & ((1 << checksum_length) - 1)
     entropy_bytes = int.to_bytes(entropy, length=entropy_length//8, byteorder="big")
     hashed = int.from_bytes(sha256(entropy_bytes), byteorder="big")
     calculated_checksum = hashed >> (256 - checksum_length)
@@ -753,23 +858,24 @@ def parse_xpubkey(x_pubkey):
 
 
 def xpubkey_to_address(x_pubkey):
-    if x_pubkey[0:2] == 'fd':
+    prefix = x_pubkey[0:2]
+    if prefix == 'fd':
         # TODO: check that ord() is OK here
         addrtype = ord(bfh(x_pubkey[2:4]))
         hash160 = bfh(x_pubkey[4:])
         address = bitcoin.hash160_to_b58_address(hash160, addrtype)
         return x_pubkey, address
-    if x_pubkey[0:2] in ['02', '03', '04']:
+    if prefix in ('02', '03', '04'):
         pubkey = x_pubkey
-    elif x_pubkey[0:2] == 'ff':
+    elif prefix == 'ff':
         xpub, s = BIP32_KeyStore.parse_xpubkey(x_pubkey)
         pubkey = BIP32_KeyStore.get_pubkey_from_xpub(xpub, s)
-    elif x_pubkey[0:2] == 'fe':
+    elif prefix == 'fe':
         mpk, s = Old_KeyStore.parse_xpubkey(x_pubkey)
         pubkey = Old_KeyStore.get_pubkey_from_mpk(mpk, s[0], s[1])
     else:
         raise QtumException("Cannot parse pubkey. prefix: {}"
-                            .format(x_pubkey[0:2]))
+                            .format(prefix))
     if pubkey:
         address = public_key_to_p2pkh(bfh(pubkey))
     return pubkey, address
@@ -862,6 +968,11 @@ def from_private_key_list(text):
     return keystore
 
 
+keystore_constructors = {ks.type: ks for ks in
+                         [Old_KeyStore, Imported_KeyStore, BIP32_KeyStore, Mobile_KeyStore, Qt_Core_Keystore]}
+keystore_constructors['hardware'] = hardware_keystore
+
+
 def load_keystore(storage, name):
     d = storage.get(name, {})
     t = d.get('type')
@@ -869,9 +980,6 @@ def load_keystore(storage, name):
         raise WalletFileException(
             'Wallet format requires update.\n'
             'Cannot find keystore for name {}'.format(name))
-    keystore_constructors = {ks.type: ks for ks in
-                             [Old_KeyStore, Imported_KeyStore, BIP32_KeyStore, Mobile_KeyStore, Qt_Core_Keystore]}
-    keystore_constructors['hardware'] = hardware_keystore
     try:
         ks_constructor = keystore_constructors[t]
     except KeyError:
@@ -937,23 +1045,37 @@ def from_xpub(xpub):
 
 
 def from_xprv(xprv):
-    xpub = bip32.xpub_from_xprv(xprv)
     k = BIP32_KeyStore({})
-    k.xprv = xprv
-    k.xpub = xpub
+    k.add_xprv(xprv)
     return k
 
 
+def _classify_master_key(text):
+    """Return 'old_mpk', 'xprv', 'xpub' or None, decoding text at most once."""
+    if is_old_mpk(text):
+        return 'old_mpk'
+    try:
+        xkey = bitcoin.DecodeBase58Check(text)
+    except Exception:
+        return None
+    for kind, prv in (('xprv', True), ('xpub', False)):
+        try:
+            bip32.deserialize_raw_xkey(xkey, prv)
+        except Exception:
+            continue
+        return kind
+    return None
+
+
 def from_master_key(text):
-    if is_xprv(text):
-        k = from_xprv(text)
-    elif is_old_mpk(text):
-        k = from_old_mpk(text)
-    elif is_xpub(text):
-        k = from_xpub(text)
-    else:
+    constructor = {
+        'xprv': from_xprv,
+        'old_mpk': from_old_mpk,
+        'xpub': from_xpub,
+    }.get(_classify_master_key(text))
+    if constructor is None:
         raise QtumException('Invalid key')
-    return k
+    return constructor(text)
 
 
 def from_qt_core_xprv(ext_master_xprv):
@@ -971,7 +1093,7 @@ def from_qt_core_xpub(xpub):
 
 
 def from_qt_core_master_key(text):
-    if is_xprv(text):
+    if _classify_master_key(text) == 'xprv':
         k = from_qt_core_xprv(text)
     # not support yet
     # elif is_xpub(text):
@@ -123,6 +123,7 @@ class Mnemonic(object):
         print_error('language', lang)
         filename = filenames.get(lang[0:2], 'english.txt')
         self.wordlist = load_wordlist(filename)
+        self.wordlist_index = {w: i for i, w in enumerate(self.wordlist)}
         print_error("wordlist has %d words"%len(self.wordlist))
 
     @classmethod
@@ -154,7 +155,7 @@ class Mnemonic(object):
         i = 0
         while words:
             w = words.pop()
-            k = self.wordlist.index(w)
+            k = self.wordlist_index[w]
             i = i*n + k
         return i
 
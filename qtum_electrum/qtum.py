@@ -444,6 +444,10 @@ assert len(__b58chars) == 58
 __b43chars = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
 assert len(__b43chars) == 43
 
+# byte value -> digit, for base_decode
+__b58digits = {c: i for i, c in enumerate(__b58chars)}
+__b43digits = {c: i for i, c in enumerate(__b43chars)}
+
 
 def base_encode(v: bytes, base: int) -> str:
     """ encode v, which is a string of bytes, to base58."""
@@ -452,9 +456,7 @@ def base_encode(v: bytes, base: int) -> str:
     chars = __b58chars
     if base == 43:
         chars = __b43chars
-    long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * c
+    long_value = int.from_bytes(v, 'big')
     result = bytearray()
     while long_value >= base:
         div, mod = divmod(long_value, base)
@@ -479,32 +481,27 @@ def base_decode(v, length, base):
     # assert_bytes(v)
     v = to_bytes(v, 'ascii')
     assert base in (58, 43)
-    chars = __b58chars
+    chars, digits = __b58chars, __b58digits
     if base == 43:
-        chars = __b43chars
+        chars, digits = __b43chars, __b43digits
     long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        digit = chars.find(bytes([c]))
-        if digit == -1:
+    for c in v:
+        digit = digits.get(c)
+        if digit is None:
             raise ValueError('Forbidden character {} for base {}'.format(c, base))
-        long_value += digit * (base ** i)
-    result = bytearray()
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result.append(mod)
-        long_value = div
-    result.append(long_value)
+        long_value = long_value * base + digit
+    # at least one byte, even for a zero value
+    result = long_value.to_bytes(max(1, (long_value.bit_length() + 7) // 8), 'big')
     nPad = 0
     for c in v:
         if c == chars[0]:
             nPad += 1
         else:
             break
-    result.extend(b'\x00' * nPad)
+    result = b'\x00' * nPad + result
     if length is not None and len(result) != length:
         return None
-    result.reverse()
-    return bytes(result)
+    return result
 
 
 class InvalidChecksum(Exception):
@@ -94,15 +94,17 @@ class JsonDB(PrintError):
             plugin_loaders[wallet_type]()
 
     def put(self, key, value):
-        try:
-            json.dumps(key, cls=util.MyEncoder)
-            json.dumps(value, cls=util.MyEncoder)
-        except:
-            self.print_error(f"json error: cannot save {repr(key)} ({repr(value)})")
-            return
         with self.db_lock:
             if value is not None:
                 if self.data.get(key) != value:
+                    # only pay for the serialization check if the value changed;
+                    # unchanged values were already checked when first stored
+                    try:
+                        json.dumps(key, cls=util.MyEncoder)
+                        json.dumps(value, cls=util.MyEncoder)
+                    except:
+                        self.print_error(f"json error: cannot save {repr(key)} ({repr(value)})")
+                        return
                     self.modified = True
                     self.data[key] = copy.deepcopy(value)
             elif key in self.data:
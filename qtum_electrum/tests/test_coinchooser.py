@@ -0,0 +1,212 @@
+from lib import coinchooser
+from lib.coinchooser import (Bucket, PRNG, bucket_weight_sums, strip_unneeded,
+                             CoinChooserOldestFirst, CoinChooserPrivacy)
+from lib.transaction import TxOutput
+from lib.qtum import TYPE_ADDRESS, hash160_to_p2pkh
+from lib.util import NotEnoughFunds
+
+from . import SequentialTestCase
+
+
+def make_bucket(desc, value, weight, height=1):
+    return Bucket(desc, weight, value, [], height, False, 1, height)
+
+
+def make_sufficient_funds(spent_amount, fee_per_weight):
+    def sufficient_funds(buckets, *, bucket_value_sum, weight_sums=None):
+        if weight_sums is None:
+            weight_sums = bucket_weight_sums(buckets)
+        return bucket_value_sum >= spent_amount + fee_per_weight * weight_sums[0]
+    return sufficient_funds
+
+
+def make_coin(i, address, value, height):
+    pubkey = '02' + '%02x' % (i + 1) * 32
+    return {'prevout_hash': '%064x' % (i + 1), 'prevout_n': 0, 'address': address,
+            'value': value, 'height': height, 'coinbase': False, 'type': 'p2pkh',
+            'num_sig': 1, 'x_pubkeys': [pubkey], 'pubkeys': [pubkey], 'signatures': [None]}
+
+
+class FakeTx:
+
+    def __init__(self, output_values, fee):
+        self.output_values = output_values
+        self.fee = fee
+
+    def outputs(self):
+        return [TxOutput(TYPE_ADDRESS, 'addr', v) for v in self.output_values]
+
+    def get_fee(self):
+        return self.fee
+
+
+class TestStripUnneeded(SequentialTestCase):
+
+    # b and c cost more in fees than they are worth, so a longer prefix can
+    # be insufficient after a shorter one was enough
+    def make_buckets(self):
+        return [make_bucket('b', 90, 1000, height=1),
+                make_bucket('c', 80, 1000, height=2),
+                make_bucket('d', 70, 10, height=3),
+                make_bucket('a', 100, 10, height=4)]
+
+    def test_first_sufficient_prefix_is_kept(self):
+        sufficient_funds = make_sufficient_funds(95, 0.1)
+        stripped = strip_unneeded(self.make_buckets(), sufficient_funds)
+        self.assertEqual(['a'], [b.desc for b in stripped])
+
+    def test_exception_bucket_is_kept_first(self):
+        sufficient_funds = make_sufficient_funds(95, 0.1)
+        stripped = strip_unneeded(self.make_buckets(), sufficient_funds, exception_addr='d')
+        self.assertEqual(['d', 'a'], [b.desc for b in stripped])
+
+    def test_no_buckets_needed(self):
+        sufficient_funds = make_sufficient_funds(0, 0)
+        self.assertEqual([], strip_unneeded(self.make_buckets(), sufficient_funds))
+
+    def test_not_enough(self):
+        sufficient_funds = make_sufficient_funds(10**6, 0.1)
+        with self.assertRaises(Exception):
+            strip_unneeded(self.make_buckets(), sufficient_funds)
+
+    def test_oldest_first_drops_buckets_worth_less_than_their_fee(self):
+        sufficient_funds = make_sufficient_funds(95, 0.1)
+        chooser = CoinChooserOldestFirst()
+        chosen = chooser.choose_buckets(self.make_buckets(), sufficient_funds, None)
+        self.assertEqual(['a'], [b.desc for b in chosen])
+
+
+class TestBucketCandidates(SequentialTestCase):
+
+    def test_candidates_are_distinct_and_sufficient(self):
+        buckets = [make_bucket(str(i), 10 * (i + 1), 10) for i in range(12)]
+        sufficient_funds = make_sufficient_funds(150, 0.1)
+        chooser = CoinChooserPrivacy()
+        chooser.p = PRNG(b'candidates')
+        candidates = chooser.bucket_candidates_any(buckets, sufficient_funds)
+        descs = [tuple(sorted(b.desc for b in c)) for c in candidates]
+        for c in candidates:
+            self.assertTrue(sufficient_funds(c, bucket_value_sum=sum(b.value for b in c)))
+        # every sufficient singleton is a candidate
+        for b in buckets:
+            if sufficient_funds([b], bucket_value_sum=b.value):
+                self.assertIn((b.desc,), descs)
+
+    def test_not_enough_funds(self):
+        buckets = [make_bucket(str(i), 10, 10) for i in range(5)]
+        chooser = CoinChooserPrivacy()
+        chooser.p = PRNG(b'candidates')
+        with self.assertRaises(NotEnoughFunds):
+            chooser.bucket_candidates_any(buckets, make_sufficient_funds(100, 0))
+        with self.assertRaises(NotEnoughFunds):
+            chooser.bucket_candidates_any([], make_sufficient_funds(100, 0))
+
+    def test_subset_pays_when_all_buckets_do_not(self):
+        # b and c cost more in fees than they are worth
+        buckets = [make_bucket('a', 100, 10),
+                   make_bucket('b', 90, 2000),
+                   make_bucket('c', 80, 1000)]
+        sufficient_funds = make_sufficient_funds(95, 0.1)
+        self.assertFalse(sufficient_funds(buckets, bucket_value_sum=270))
+        for seed in (b'candidates', b'other', b'more'):
+            chooser = CoinChooserPrivacy()
+            chooser.p = PRNG(seed)
+            candidates = chooser.bucket_candidates_any(buckets, sufficient_funds)
+            self.assertEqual([['a']], [[b.desc for b in c] for c in candidates])
+
+    def test_restricted_domain(self):
+        # far more buckets than needed: only the largest ones are shuffled
+        buckets = [make_bucket('big', 1000, 0)] + [make_bucket('s%d' % i, 10, 0) for i in range(60)]
+        sufficient_funds = make_sufficient_funds(1100, 0)
+        chooser = CoinChooserPrivacy()
+        chooser.p = PRNG(b'candidates')
+        candidates = chooser.bucket_candidates_any(buckets, sufficient_funds)
+        self.assertTrue(candidates)
+        for c in candidates:
+            self.assertEqual(11, len(c))
+            self.assertEqual(1100, sum(b.value for b in c))
+
+    def test_restricted_domain_falls_back_to_all_buckets(self):
+        # the largest buckets only pay if x1 and x2 come before the heavy
+        # h buckets; the small ones are needed otherwise
+        buckets = ([make_bucket('x1', 60, 10), make_bucket('x2', 55, 10)]
+                   + [make_bucket('h%d' % i, 50 - i, 1000) for i in range(4)]
+                   + [make_bucket('s%d' % i, 10, 10) for i in range(30)])
+        sufficient_funds = make_sufficient_funds(100, 0.1)
+        for seed in (b'candidates', b'other', b'more'):
+            chooser = CoinChooserPrivacy()
+            chooser.p = PRNG(seed)
+            candidates = chooser.bucket_candidates_any(buckets, sufficient_funds)
+            self.assertTrue(any(b.desc.startswith('s') for c in candidates for b in c))
+            for c in candidates:
+                self.assertTrue(sufficient_funds(c, bucket_value_sum=sum(b.value for b in c)))
+
+    def test_penalty_cutoff(self):
+        chooser = CoinChooserPrivacy()
+        penalty = chooser.penalty_func(FakeTx([10**6], 0))
+        buckets = [make_bucket(str(i), 4 * 10**5, 10) for i in range(4)]
+        full = penalty(buckets)
+        self.assertEqual(full, penalty(buckets, full))
+        self.assertEqual(float('inf'), penalty(buckets, 2.5))
+
+
+class TestChangeAmounts(SequentialTestCase):
+
+    def change_amounts(self, output_values, fee, count, rounding=False):
+        chooser = CoinChooserPrivacy()
+        chooser.enable_output_value_rounding = rounding
+        chooser.p = PRNG(b'change')
+        return chooser.change_amounts(FakeTx(output_values, fee), count,
+                                      lambda n: 1000 * n, 546)
+
+    def test_split_change(self):
+        self.assertEqual([24335000, 30991600, 43435832],
+                         self.change_amounts([1234500], 98765432, 3))
+        self.assertEqual([9000000, 14755000, 10000000, 11919901],
+                         self.change_amounts([2000000, 30000], 45678901, 4))
+        # a zero output, e.g. a contract call
+        self.assertEqual([356000000, 421775777],
+                         self.change_amounts([0, 10**8], 777777777, 2))
+
+    def test_rounded_change(self):
+        self.assertEqual([1360000, 1135700],
+                         self.change_amounts([1500000], 2497740, 3, rounding=True))
+        self.assertEqual([1233500],
+                         self.change_amounts([1500000], 1234567, 1, rounding=True))
+
+
+class TestMakeTx(SequentialTestCase):
+
+    specs = [(10**6, 100), (2 * 10**6, 50), (5 * 10**5, 200), (3 * 10**6, 0),
+             (10**5, 10), (7 * 10**6, 300), (12345678, 20), (4 * 10**6, 5)]
+
+    def make_tx(self, kind, amount, num_change):
+        addrs = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(8)]
+        coins = [make_coin(i, addrs[i % 4], value, height)
+                 for i, (value, height) in enumerate(self.specs)]
+        change_addrs = [addrs[6], addrs[7], addrs[5]][:num_change]
+        chooser = coinchooser.COIN_CHOOSERS[kind]()
+        tx = chooser.make_tx(coins, [], [TxOutput(TYPE_ADDRESS, addrs[4], amount)],
+                             change_addrs, lambda size: size * 10, 546)
+        inputs = sorted(int(txin['prevout_hash'], 16) - 1 for txin in tx.inputs())
+        return inputs, [o.value for o in tx.outputs()]
+
+    def test_privacy(self):
+        self.assertEqual(([0, 4], [150000, 946260]), self.make_tx('Privacy', 150000, 1))
+        self.assertEqual(([1, 5], [1500000, 7496260]), self.make_tx('Privacy', 1500000, 1))
+        self.assertEqual(([1, 5], [1500000, 2650000, 3000000, 1845580]),
+                         self.make_tx('Privacy', 1500000, 3))
+        self.assertEqual(([2, 6], [6000000, 6841938]), self.make_tx('Privacy', 6000000, 3))
+        self.assertEqual(([1, 2, 5, 6], [20000000, 1838978]), self.make_tx('Privacy', 20000000, 3))
+
+    def test_oldest_first(self):
+        self.assertEqual(([7], [150000, 3847740]), self.make_tx('OldestFirst', 150000, 1))
+        self.assertEqual(([7], [150000, 2470000, 1377400]), self.make_tx('OldestFirst', 150000, 3))
+        self.assertEqual(([6], [6000000, 6343418]), self.make_tx('OldestFirst', 6000000, 3))
+        self.assertEqual(([5, 6, 7], [20000000, 3340458]), self.make_tx('OldestFirst', 20000000, 3))
+
+    def test_not_enough_funds(self):
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx('Privacy', 10**9, 1)
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx('OldestFirst', 10**9, 1)
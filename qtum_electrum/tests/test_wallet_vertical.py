@@ -1131,3 +1131,139 @@ class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
                                    {})
         w.synchronize()
         self.assertEqual(9999788, sum(w.get_balance()))
+
+
+class TestWalletHistory_BalanceCache(TestCaseForTestnet):
+    # coinbase paying 40 QTUM to qXrcPCuHu2xk8skqggk6EAHhVxBBtzn69k
+    coinbase_tx = "01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff0403a08601ffffffff0100286bee000000001976a9149cd3dfb0d87a861770ae4e268e74b45335cf00ab88ac00000000"
+    address = "qXrcPCuHu2xk8skqggk6EAHhVxBBtzn69k"
+
+    def set_tip(self, w, height):
+        w.storage.put('stored_height', height)
+        w.on_blockchain_updated('blockchain_updated')
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_coinbase_maturity(self, mock_write):
+        w = TestWalletHistory_SimpleRandomOrder.create_old_wallet()
+        tx = Transaction(self.coinbase_tx)
+        height = 100000
+        self.set_tip(w, height + qtum.COINBASE_MATURITY - 1)
+        w.receive_tx_callback(tx.txid(), tx, height)
+        self.assertEqual((0, 0, 4000000000), w.get_balance())
+        # the coinbase matures
+        self.set_tip(w, height + qtum.COINBASE_MATURITY)
+        self.assertEqual((4000000000, 0, 0), w.get_balance())
+        # the tip goes back down
+        self.set_tip(w, height + qtum.COINBASE_MATURITY - 1)
+        self.assertEqual((0, 0, 4000000000), w.get_balance())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_tx_made_local(self, mock_write):
+        w = TestWalletHistory_SimpleRandomOrder.create_old_wallet()
+        txid = '9de08bcafc602a3d2270c46cbad1be0ef2e96930bec3944739089f960652e7cb'
+        w.transactions[txid] = Transaction(TestWalletHistory_SimpleRandomOrder.transactions[txid])
+        w.storage.put('stored_height', 2000)
+        w.receive_history_callback(self.address, [(txid, 1000)], {})
+        self.assertEqual((15000000, 0, 0), w.get_addr_balance(self.address))
+        # the server no longer has the tx in our history
+        w.receive_history_callback(self.address, [], {})
+        self.assertEqual((0, 15000000, 0), w.get_addr_balance(self.address))
+
+
+class TestWalletHistory_Indexes(TestCaseForTestnet):
+    txorder = [2, 12, 7, 9, 11, 10, 16, 6, 17, 1, 13, 15, 5, 8, 4, 0, 14, 18, 3]
+
+    def create_wallet_with_history(self, txorder=None, save_each=False):
+        w = TestWalletHistory_SimpleRandomOrder.create_old_wallet()
+        txs = TestWalletHistory_SimpleRandomOrder.transactions
+        txid_list = TestWalletHistory_SimpleRandomOrder.txid_list
+        for i in txorder or self.txorder:
+            tx = Transaction(txs[txid_list[i]])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+            if save_each:
+                w.save_transactions()
+        return w
+
+    def remove_all_transactions(self, w):
+        for txid in list(w.transactions):
+            w.remove_transaction(txid)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_remove_transaction_clears_txo_by_n(self, mock_write):
+        w = self.create_wallet_with_history()
+        self.assertEqual(set(w.txo), set(w._txo_by_n))
+        self.remove_all_transactions(w)
+        self.assertEqual({}, w.txo)
+        self.assertEqual({}, w._txo_by_n)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_outpoint_storage_roundtrip(self, mock_write):
+        w = self.create_wallet_with_history()
+        w.save_transactions()
+        # tuples in memory, 'prevout_hash:n' strings on disk
+        for txid, d in w.txi.items():
+            stored = w.storage.get('txi')[txid]
+            self.assertEqual(set(d), set(stored))
+            for addr, s in d.items():
+                self.assertEqual(sorted('%s:%d' % ser for ser, v in s),
+                                 sorted(ser for ser, v in stored[addr]))
+                for (prevout_hash, prevout_n), v in s:
+                    self.assertIsInstance(prevout_n, int)
+        w2 = lib.wallet.Standard_Wallet(w.storage)
+        self.assertEqual(w.txi, w2.txi)
+        self.assertEqual(w.txo, w2.txo)
+        self.assertEqual(dict(w.spent_outpoints), dict(w2.spent_outpoints))
+        self.assertEqual(w.get_balance(), w2.get_balance())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_remove_transaction_clears_spent_outpoints(self, mock_write):
+        w = self.create_wallet_with_history()
+        self.assertEqual(set(w.transactions), set(w._spent_outpoints_by_txid))
+        self.remove_all_transactions(w)
+        self.assertEqual({}, w._spent_outpoints_by_txid)
+        self.assertEqual({}, dict(w.spent_outpoints))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_remove_transaction_clears_stored_txi(self, mock_write):
+        w = self.create_wallet_with_history()
+        w.save_transactions()
+        self.assertEqual(set(w.txi), set(w._txi_stored))
+        self.assertEqual(set(), w._txi_dirty)
+        self.remove_all_transactions(w)
+        self.assertEqual({}, w.txi)
+        w.save_transactions()
+        self.assertEqual({}, w._txi_stored)
+        self.assertEqual(set(), w._txi_dirty)
+        self.assertEqual({}, w.storage.get('txi'))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_dirty_txi_save(self, mock_write):
+        # children before parents, so adding a parent updates the txi of
+        # already saved children
+        w = self.create_wallet_with_history(txorder=self.txorder[::-1], save_each=True)
+        w2 = lib.wallet.Standard_Wallet(w.storage)
+        self.assertEqual(w.txi, w2.txi)
+        self.assertEqual(w.get_balance(), w2.get_balance())
+        self.assertEqual(27633300, sum(w2.get_balance()))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_remove_transaction_clears_addr_io(self, mock_write):
+        w = self.create_wallet_with_history()
+        self.assertTrue(any(w._addr_received.values()))
+        self.assertTrue(any(w._addr_sent.values()))
+        self.remove_all_transactions(w)
+        self.assertFalse(any(w._addr_received.values()))
+        self.assertFalse(any(w._addr_sent.values()))
+        self.assertEqual((0, 0, 0), w.get_balance())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_clear_history_resets_wallet_delta(self, mock_write):
+        w = self.create_wallet_with_history()
+        # txs spending our coins: their deltas depend on the cleared txo
+        spending = [tx for tx in w.transactions.values() if w.get_wallet_delta(tx)[1]]
+        self.assertTrue(spending)
+        deltas = [w.get_wallet_delta(tx) for tx in spending]
+        w.clear_history()
+        self.assertNotEqual(deltas, [w.get_wallet_delta(tx) for tx in spending])
+        self.assertEqual([w._get_wallet_delta(tx) for tx in spending],
+                         [w.get_wallet_delta(tx) for tx in spending])
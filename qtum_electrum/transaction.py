@@ -740,13 +740,14 @@ class Transaction:
     @classmethod
     def estimate_pubkey_size_from_x_pubkey(cls, x_pubkey):
         try:
-            if x_pubkey[0:2] in ['02', '03']:  # compressed pubkey
+            prefix = x_pubkey[0:2]
+            if prefix in ('02', '03'):  # compressed pubkey
                 return 0x21
-            elif x_pubkey[0:2] == '04':  # uncompressed pubkey
+            elif prefix == '04':  # uncompressed pubkey
                 return 0x41
-            elif x_pubkey[0:2] == 'ff':  # bip32 extended pubkey
+            elif prefix == 'ff':  # bip32 extended pubkey
                 return 0x21
-            elif x_pubkey[0:2] == 'fe':  # old electrum extended pubkey
+            elif prefix == 'fe':  # old electrum extended pubkey
                 return 0x41
         except Exception as e:
             pass
@@ -1159,6 +1160,8 @@ class Transaction:
 
     def sign(self, keypairs) -> None:
         # keypairs:  (x_)pubkey -> secret_bytes
+        # inputs often share a key; set each one up only once
+        privkeys = {}  # secret_bytes -> ECPrivkey
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
@@ -1171,13 +1174,18 @@ class Transaction:
                 else:
                     continue
                 sec, compressed = keypairs.get(_pubkey)
-                sig = self.sign_txin(i, sec)
+                privkey = privkeys.get(sec)
+                if privkey is None:
+                    privkey = privkeys[sec] = ecc.ECPrivkey(sec)
+                sig = self._sign_txin(i, privkey)
                 self.add_signature_to_txin(i, j, sig)
         self.raw = self.serialize()
 
     def sign_txin(self, txin_index, privkey_bytes) -> str:
+        return self._sign_txin(txin_index, ecc.ECPrivkey(privkey_bytes))
+
+    def _sign_txin(self, txin_index, privkey) -> str:
         pre_hash = sha256d(bfh(self.serialize_preimage(txin_index)))
-        privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
         sig = bh2u(sig) + '01'
         return sig
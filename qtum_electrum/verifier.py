@@ -45,6 +45,7 @@ class SPV(ThreadJob):
         self.requested_merkle = set()  # txid set of pending requests
 
     def run(self):
+        self.wallet.notify_verified_txs()
         interface = self.network.interface
         if not interface:
             return
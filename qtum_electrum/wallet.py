@@ -35,7 +35,7 @@ import json
 from typing import List, Tuple, Optional, TYPE_CHECKING, NamedTuple
 
 from .i18n import _
-from .util import NotEnoughFunds, UserCancelled, profiler, format_satoshis, \
+from .util import NotEnoughFunds, UserCancelled, format_satoshis, \
     InvalidPassword, WalletFileException, TimeoutException, format_time, bh2u, TxMinedInfo
 from .qtum import (TYPE_ADDRESS, TYPE_STAKE, is_address, is_minikey,
                    RECOMMEND_CONFIRMATIONS, COINBASE_MATURITY, TYPE_PUBKEY, b58_address_to_hash160,
@@ -238,29 +238,6 @@ class Abstract_Wallet(AddressSynchronizer):
     def get_master_public_key(self):
         return None
 
-
-    @profiler
-    def check_history(self):
-        save = False
-        hist_addrs_mine = list(filter(lambda k: self.is_mine(k), self.history.keys()))
-        hist_addrs_not_mine = list(filter(lambda k: not self.is_mine(k), self.history.keys()))
-        for addr in hist_addrs_not_mine:
-            self.history.pop(addr)
-            save = True
-
-        for addr in hist_addrs_mine:
-            hist = self.history[addr]
-
-            for tx_hash, tx_height in hist:
-                if self.txi.get(tx_hash) or self.txo.get(tx_hash):
-                    continue
-                tx = self.transactions.get(tx_hash)
-                if tx is not None:
-                    self.add_transaction(tx_hash, tx, allow_unrelated=True)
-                    save = True
-        if save:
-            self.save_transactions()
-
     def basename(self):
         return os.path.basename(self.storage.path)
 
@@ -433,12 +410,11 @@ class Abstract_Wallet(AddressSynchronizer):
         return self.get_balance(self.frozen_addresses)
 
     def find_pay_to_pubkey_address(self, prevout_hash, prevout_n):
-        dd = self.txo.get(prevout_hash, {})
-        for addr, l in dd.items():
-            for n, v, is_cb in l:
-                if n == prevout_n:
-                    self.print_error("found pay-to-pubkey address:", addr)
-                    return addr
+        prevout = self._txo_by_n.get(prevout_hash, {}).get(prevout_n)
+        if prevout:
+            addr = prevout[0]
+            self.print_error("found pay-to-pubkey address:", addr)
+            return addr
 
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
@@ -758,7 +734,7 @@ class Abstract_Wallet(AddressSynchronizer):
         else:
             return
         coins = self.get_addr_utxo(address)
-        item = coins.get(txid+':%d'%i)
+        item = coins.get((txid, i))
         if not item:
             return
         self.add_input_info(item)
@@ -789,7 +765,7 @@ class Abstract_Wallet(AddressSynchronizer):
             # segwit needs value to sign
             if txin.get('value') is None:
                 received, spent = self.get_addr_io(address)
-                item = received.get(txin['prevout_hash']+':%d' % txin['prevout_n'])
+                item = received.get((txin['prevout_hash'], txin['prevout_n']))
                 if item:
                     txin['value'] = item[1]
             self.add_input_sig_info(txin, address)
@@ -882,7 +858,7 @@ class Abstract_Wallet(AddressSynchronizer):
         l = []
         for txo, x in received.items():
             h, v, is_cb = x
-            txid, n = txo.split(':')
+            txid, n = txo
             info = self.verified_tx.get(txid)
             if info:
                 conf = local_height - info.height
@@ -1254,6 +1230,7 @@ class Imported_Wallet(Simple_Wallet):
 
         pubkey = self.get_public_key(address)
         self.addresses.pop(address)
+        self._mine_epoch += 1
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
@@ -1270,6 +1247,9 @@ class Imported_Wallet(Simple_Wallet):
         self.save_addresses()
         self.storage.write()
 
+    def is_mine(self, address):
+        return address in self.addresses
+
     def get_address_index(self, address):
         return self.get_public_key(address)
 
@@ -1455,6 +1435,9 @@ class Deterministic_Wallet(Abstract_Wallet):
                 return False
         return True
 
+    def is_mine(self, address):
+        return address in self._addr_to_addr_index
+
     def get_address_index(self, address):
         return self._addr_to_addr_index[address]
 